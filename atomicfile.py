@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""Replace files in one step, so nobody ever sees one half-written."""
+# Copyright © 2015 Timothy Pederick.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+from contextlib import contextmanager, suppress
+import os
+import os.path
+import secrets
+import shutil
+
+
+@contextmanager
+def replacing(filename, suffix=''):
+    """Write a new file in a temporary file, then move it into place.
+
+    The temporary file is created alongside the file it replaces. If
+    there is no old file, the new one is created with the permissions
+    allowed by the process's umask, as by open(); otherwise it takes
+    the permissions of the old one. If the block raises an exception,
+    the temporary file is thrown away and the old file is untouched.
+        >>> import tempfile
+        >>> data_dir = tempfile.TemporaryDirectory()
+        >>> filename = os.path.join(data_dir.name, 'example.txt')
+        >>> with replacing(filename) as tempname:
+        ...     with open(tempname, 'w', encoding='utf-8') as file:
+        ...         _ = file.write('new')
+        >>> with open(filename, encoding='utf-8') as file:
+        ...     file.read()
+        'new'
+        >>> os.listdir(data_dir.name)
+        ['example.txt']
+        >>> data_dir.cleanup()
+
+    Keyword arguments:
+        filename -- The name of the file to replace.
+        suffix -- A suffix for the name of the temporary file. The
+            default is no suffix.
+
+    Yields:
+        The name of the temporary file, which exists but is empty.
+
+    Raises:
+        OSError -- If the temporary file cannot be created or moved.
+
+    """
+    directory, basename = os.path.split(os.path.abspath(filename))
+    while True:
+        tempname = os.path.join(directory, '.{}.{}{}'.format(
+            basename, secrets.token_hex(4), suffix))
+        try:
+            # Unlike tempfile.mkstemp(), which only lets the owner read the
+            # file, this leaves the permissions to the umask.
+            fd = os.open(tempname, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                         0o666)
+        except FileExistsError:
+            continue
+        break
+    os.close(fd)
+
+    try:
+        yield tempname
+        if os.path.isfile(filename):
+            shutil.copymode(filename, tempname)
+        os.replace(tempname, filename)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(tempname)
+        raise
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+
+"""Benchmark the stages of rules-based generation.
+
+Each stage (parsing rules, sorting them, expanding them, building the
+database, looking up data and generating strings) is run repeatedly on
+the bundled Academia and Technobabble data, and on synthetic data whose
+shape can be tuned from the command line. The throughput, latency
+percentiles and peak memory of each stage are reported, as a table or
+as JSON for comparing runs over time.
+
+Run "python -m benchmark --help" for usage.
+
+"""
+# Copyright © 2015 Timothy Pederick.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+import csv
+from datetime import datetime, timezone
+import io
+from itertools import cycle
+import json
+import os.path
+import platform
+import random
+import shutil
+import string
+import sys
+from tempfile import TemporaryDirectory
+import time
+import tracemalloc
+
+# Local imports.
+import rulegen
+from ruleparser import (all_terminals, count_terminals, parse_rule,
+                        parse_rules, DBLookup, Nonterminal, INITIAL)
+from toposort import toposort
+
+# The bundled generators, by name, with the directories of their data.
+BUNDLED = {'academia': 'Academia', 'technobabble': 'Technobabble'}
+
+# The stages benchmarked, in the order they are run.
+STAGES = ('parse_rule', 'parse_rules', 'toposort', 'all_terminals', 'build_db',
+          'get_data', 'generate', 'generate_many')
+
+# The stages that look data up, and so need the database built first.
+LOOKUP_STAGES = ('get_data', 'generate', 'generate_many')
+
+# The percentiles of latency to report.
+PERCENTILES = (50, 90, 99)
+
+
+def synthetic_rules(nonterminals=20, fanout=2, option_density=0.2, depth=3,
+                    alternatives=2, columns=6, seed=0):
+    """Make up a rules file.
+
+    The nonterminals are arranged in levels, with <RESULT> alone at the
+    top. Each refers only to nonterminals on the level below it, and
+    those on the bottom level refer only to columns of data, so the
+    rules always have a finite expansion. Note that the number of
+    output formats grows exponentially with the depth and fan-out.
+
+    Keyword arguments:
+        nonterminals -- The number of nonterminals, including <RESULT>.
+            This is raised to the depth if it is less, and lowered to
+            the most that can be reached from <RESULT> if it is more.
+        fanout -- The number of tokens in each alternative.
+        option_density -- The probability that each token is optional.
+        depth -- The number of levels of nonterminals.
+        alternatives -- The number of alternatives in each rule.
+        columns -- The number of data columns, named "Col0", "Col1" and
+            so on.
+        seed -- The seed for the random choices.
+
+    Returns:
+        A string containing the rules.
+
+    """
+    rng = random.Random(seed)
+    nonterminals = max(nonterminals, depth)
+    levels = [[INITIAL]]
+    names = ['n{}'.format(n) for n in range(1, nonterminals)]
+    for level in range(1, depth):
+        # Share the rest out as evenly as possible, one level at a time,
+        # but no more than the level above can refer to.
+        count = min(len(names) // (depth - level),
+                    len(levels[-1]) * alternatives * fanout)
+        levels.append(names[:count])
+        del names[:count]
+
+    lines = []
+    for level, level_names in enumerate(levels):
+        below = levels[level + 1] if level + 1 < depth else None
+        # Make sure that every nonterminal on the next level is used.
+        unused = [] if below is None else list(below)
+        rng.shuffle(unused)
+        for name in level_names:
+            alts = []
+            for _ in range(alternatives):
+                items = []
+                for n in range(fanout):
+                    if below is None:
+                        token = '[Col{}]'.format(rng.randrange(columns))
+                    elif len(unused) > 0:
+                        token = '<{}>'.format(unused.pop())
+                    else:
+                        token = '<{}>'.format(rng.choice(below))
+                    if n > 0 and rng.random() < 0.5:
+                        items.append('" "')
+                    optional = n > 0 and rng.random() < option_density
+                    items.append(('?' if optional else '') + token)
+                alts.append(' '.join(items))
+            lines.append('<{}> = {}'.format(name, ' | '.join(alts)))
+    return '\n'.join(lines) + '\n'
+
+
+def synthetic_csv(roots=1000, columns=6, density=0.3, seed=0):
+    """Make up a CSV file of roots.
+
+    Keyword arguments:
+        roots -- The number of rows.
+        columns -- The number of columns, named as for synthetic_rules().
+        density -- The probability that each cell is filled in. The
+            first ten rows are always filled in, so that every column
+            has enough values for any format.
+        seed -- The seed for the random choices.
+
+    Returns:
+        A string containing the CSV data.
+
+    """
+    rng = random.Random(seed)
+    file = io.StringIO(newline='')
+    writer = csv.writer(file, lineterminator='\n')
+    writer.writerow(['Col{}'.format(n) for n in range(columns)])
+    for row in range(roots):
+        writer.writerow([''.join(rng.choice(string.ascii_lowercase)
+                                 for _ in range(rng.randint(3, 10)))
+                         if row < 10 or rng.random() < density else ''
+                         for _ in range(columns)])
+    return file.getvalue()
+
+
+def measure(func, min_calls=5, max_calls=10000, max_time=1.0, batch=1):
+    """Time repeated calls of a function.
+
+    The function is called at least min_calls times, and then until
+    either max_calls calls or max_time seconds are reached. After that
+    it is called once more, with memory tracing on, to find the peak
+    memory allocated during a call.
+
+    Keyword arguments:
+        func -- A function to call, with no arguments.
+        min_calls, max_calls -- The bounds on the number of calls.
+        max_time -- The time limit, in seconds.
+        batch -- The number of operations done by each call, for
+            working out the throughput.
+
+    Returns:
+        A dictionary of results.
+
+    """
+    latencies = []
+    started = time.perf_counter()
+    while len(latencies) < max_calls:
+        start = time.perf_counter()
+        func()
+        end = time.perf_counter()
+        latencies.append(end - start)
+        if len(latencies) >= min_calls and end - started >= max_time:
+            break
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    total = sum(latencies)
+    latencies.sort()
+    return {'calls': len(latencies),
+            'ops': len(latencies) * batch,
+            'total_s': total,
+            'ops_per_s': len(latencies) * batch / total if total > 0 else None,
+            'latency_s': dict([('mean', total / len(latencies))] +
+                              [('p{}'.format(percentile),
+                                _percentile(latencies, percentile))
+                               for percentile in PERCENTILES] +
+                              [('max', latencies[-1])]),
+            'peak_bytes': peak}
+
+
+def _percentile(values, percentile):
+    """Get a percentile of a sorted list, by the nearest-rank method."""
+    rank = max(1, -(-len(values) * percentile // 100))
+    return values[rank - 1]
+
+
+def benchmark_dataset(generator, stages=None, batch=1000, **limits):
+    """Benchmark every stage on one generator's data.
+
+    The database is only built if a stage that uses it is run, and the
+    output formats are only counted exactly if that can be done within
+    the default limit of count_terminals(); otherwise the info reports
+    an upper bound, as "max_formats".
+
+    Keyword arguments:
+        generator -- A Rulegen instance. Its database is rebuilt, if a
+            stage needs it.
+        stages -- A collection of the names of the stages to run. The
+            default is to run all of them.
+        batch -- The number of strings generated by each call of the
+            "generate_many" stage.
+        limits -- Passed on to measure().
+
+    Returns:
+        A dictionary with an "info" member, describing the data, and a
+        "stages" member, mapping the name of each stage to its results.
+
+    """
+    with open(generator.rulefile, encoding='utf-8') as file:
+        lines = [line for line in file if line.strip() != '']
+    rules = parse_rules(generator.rulefile)
+    graph = {nonterminal: [token.content for token in production
+                           if isinstance(token, Nonterminal)]
+             for nonterminal, production in rules.items()}
+    colnames = sorted({token.content for production in rules.values()
+                       for token in production
+                       if isinstance(token, DBLookup)})
+    if stages is None or not set(stages).isdisjoint(LOOKUP_STAGES):
+        generator.build_db()
+
+    rule_lines = cycle(lines)
+    lookup_columns = cycle(colnames)
+    all_stages = [
+        ('parse_rule', 1, lambda: parse_rule(next(rule_lines))),
+        ('parse_rules', 1, lambda: parse_rules(generator.rulefile)),
+        ('toposort', 1, lambda: toposort(graph)),
+        ('all_terminals', 1, lambda: list(all_terminals(rules))),
+        ('build_db', 1, generator.build_db),
+        ('get_data', 1, lambda: generator.get_data(next(lookup_columns))),
+        ('generate', 1, generator.generate),
+        ('generate_many', batch, lambda: generator.generate_many(batch)),
+    ]
+
+    results = {}
+    for name, ops, func in all_stages:
+        if stages is None or name in stages:
+            results[name] = measure(func, batch=ops, **limits)
+    generator.close()
+
+    with open(generator.csvfile, encoding='utf-8', newline='') as file:
+        roots = sum(1 for _ in csv.reader(file)) - 1
+    formats = count_terminals(rules)
+    info = {'rules': len(lines), 'nonterminals': len(rules)}
+    if formats is None:
+        info['max_formats'] = count_terminals(rules, upper_bound=True)
+    else:
+        info['formats'] = formats
+    info.update(roots=roots, columns=len(colnames))
+    return {'info': info, 'stages': results}
+
+
+def _copy_generator(template, data_dir):
+    """Make a generator like a bundled one, working in another directory."""
+    return type(template)(template.data_prefix, data_dir,
+                          postprocessors=template.postprocessors)
+
+
+def format_table(report):
+    """Format a report as a plain-text table."""
+    lines = []
+    for dataset, results in report['datasets'].items():
+        lines.append('{} ({})'.format(dataset, ', '.join(
+            '{} {}'.format(value, key)
+            for key, value in results['info'].items())))
+        lines.append('  {:<14} {:>12} {:>11} {:>11} {:>11} {:>12}'.format(
+            'stage', 'ops/s', 'p50', 'p90', 'p99', 'peak mem'))
+        for stage, result in results['stages'].items():
+            latency = result['latency_s']
+            lines.append('  {:<14} {:>12.1f} {:>11} {:>11} {:>11} {:>12}'
+                         .format(stage, result['ops_per_s'] or 0,
+                                 *(_format_time(latency[key])
+                                   for key in ('p50', 'p90', 'p99')),
+                                 _format_size(result['peak_bytes'])))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def _format_time(seconds):
+    """Format a time in seconds with a sensible unit."""
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:.2f} {}'.format(seconds / scale, unit)
+    return '{:.0f} ns'.format(seconds * 1e9)
+
+
+def _format_size(size):
+    """Format a number of bytes with a sensible unit."""
+    for unit, scale in (('MiB', 1 << 20), ('KiB', 1 << 10)):
+        if size >= scale:
+            return '{:.1f} {}'.format(size / scale, unit)
+    return '{} B'.format(size)
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line.
+
+    Keyword arguments:
+        argv -- A list of command-line arguments, not including the
+            program name. The default is sys.argv[1:].
+
+    Returns:
+        An exit status.
+
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmark',
+        description='Benchmark the stages of rules-based generation.')
+    parser.add_argument('datasets', nargs='*',
+                        help='the data to benchmark with: {} (default: '
+                        'all)'.format(', '.join(sorted(BUNDLED) +
+                                                ['synthetic'])))
+    parser.add_argument('--stage', action='append', dest='stages',
+                        choices=STAGES,
+                        help='run only this stage (may be repeated)')
+    parser.add_argument('--json', metavar='FILE',
+                        help='write the results as JSON to FILE ("-" for '
+                        'standard output)')
+    parser.add_argument('--max-time', type=float, default=1.0,
+                        help='seconds to spend on each stage (default: 1)')
+    parser.add_argument('--max-calls', type=int, default=10000,
+                        help='most calls to make of each stage '
+                        '(default: 10000)')
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='strings per generate_many() call '
+                        '(default: 1000)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the synthetic data and for '
+                        'generation (default: 0)')
+    synthetic = parser.add_argument_group('synthetic data')
+    synthetic.add_argument('--nonterminals', type=int, default=20)
+    synthetic.add_argument('--fanout', type=int, default=2)
+    synthetic.add_argument('--option-density', type=float, default=0.2)
+    synthetic.add_argument('--depth', type=int, default=3)
+    synthetic.add_argument('--alternatives', type=int, default=2)
+    synthetic.add_argument('--columns', type=int, default=6)
+    synthetic.add_argument('--roots', type=int, default=1000)
+    synthetic.add_argument('--root-density', type=float, default=0.3)
+    args = parser.parse_args(argv)
+    for dataset in args.datasets:
+        if dataset not in BUNDLED and dataset != 'synthetic':
+            parser.error('unknown dataset: {!r}'.format(dataset))
+
+    report = {'started': datetime.now(timezone.utc).isoformat(),
+              'python': platform.python_version(),
+              'implementation': platform.python_implementation(),
+              'platform': platform.platform(),
+              'numpy': rulegen.numpy is not None,
+              'parameters': {key: value for key, value in vars(args).items()
+                             if key not in ('datasets', 'json')},
+              'datasets': {}}
+    limits = {'max_time': args.max_time, 'max_calls': args.max_calls}
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    for dataset in args.datasets or sorted(BUNDLED) + ['synthetic']:
+        random.seed(args.seed)
+        # Work on copies of the data, so that the databases built don't
+        # disturb (or get disturbed by) anything else.
+        with TemporaryDirectory() as data_dir:
+            if dataset in BUNDLED:
+                for ext in ('.csv', '.rules'):
+                    shutil.copy(os.path.join(here, BUNDLED[dataset],
+                                             dataset + ext), data_dir)
+                generator = _copy_generator(rulegen.generators[dataset],
+                                            data_dir)
+            else:
+                with open(os.path.join(data_dir, dataset + '.rules'), 'w',
+                          encoding='utf-8') as file:
+                    file.write(synthetic_rules(args.nonterminals, args.fanout,
+                                               args.option_density, args.depth,
+                                               args.alternatives, args.columns,
+                                               args.seed))
+                with open(os.path.join(data_dir, dataset + '.csv'), 'w',
+                          encoding='utf-8', newline='') as file:
+                    file.write(synthetic_csv(args.roots, args.columns,
+                                             args.root_density, args.seed))
+                generator = rulegen.Rulegen(dataset, data_dir)
+            report['datasets'][dataset] = benchmark_dataset(
+                generator, args.stages, args.batch, **limits)
+
+    if args.json is None:
+        print(format_table(report))
+    elif args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
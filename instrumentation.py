@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""Lightweight counters and timers for finding where time goes."""
+# Copyright © 2015 Timothy Pederick.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+from contextlib import contextmanager, nullcontext
+import threading
+from time import perf_counter
+
+# The percentiles estimated from each latency histogram.
+PERCENTILES = (50, 90, 99)
+
+
+class Stats:
+    """A set of named counters and latency histograms.
+
+    Nothing is recorded unless the enabled attribute is true. Code that
+    records into a Stats instance on a hot path should check that
+    attribute itself before doing any work, so that a disabled instance
+    costs no more than one attribute lookup:
+        >>> stats = Stats()
+        >>> if stats.enabled:
+        ...     stats.count('calls')
+        >>> stats.snapshot()
+        {'counters': {}, 'timings': {}}
+        >>> stats.enabled = True
+        >>> stats.count('calls', 2)
+        >>> stats.record('work', 0.003)
+        >>> snapshot = stats.snapshot()
+        >>> snapshot['counters'], snapshot['timings']['work']['count']
+        ({'calls': 2}, 1)
+
+    Latencies are kept in histograms with a bucket for each power of
+    two nanoseconds, so percentiles are estimates, accurate to within a
+    factor of two.
+
+    Attributes:
+        enabled -- True if anything is to be recorded. The default is
+            False.
+        hooks -- A list of callables, each called with the arguments
+            (kind, name, value) whenever anything is recorded. The kind
+            is either "count", with the amount added as the value, or
+            "timing", with the latency in seconds as the value. Use
+            these to pass the numbers on to a metrics system.
+
+    """
+    def __init__(self, enabled=False):
+        """Initialise the counters and histograms, all empty.
+
+        Keyword arguments:
+            enabled -- As the instance attribute.
+
+        """
+        self.enabled = enabled
+        self.hooks = []
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+
+    def count(self, name, amount=1):
+        """Add to a counter."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+        for hook in self.hooks:
+            hook('count', name, amount)
+
+    def record(self, name, seconds):
+        """Record one latency, in seconds."""
+        bucket = int(seconds * 1e9).bit_length()
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = [0, 0.0, seconds, seconds, {}]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = min(timing[2], seconds)
+            timing[3] = max(timing[3], seconds)
+            timing[4][bucket] = timing[4].get(bucket, 0) + 1
+        for hook in self.hooks:
+            hook('timing', name, seconds)
+
+    def timer(self, name):
+        """Time a block of code, as a context manager.
+
+        If the instance is disabled, this returns a context manager
+        that does nothing.
+
+        Keyword arguments:
+            name -- The name of the histogram to record in.
+
+        """
+        return self._timer(name) if self.enabled else nullcontext()
+
+    @contextmanager
+    def _timer(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, perf_counter() - start)
+
+    def snapshot(self):
+        """Get a copy of everything recorded so far.
+
+        Returns:
+            A dictionary with two members. The "counters" member maps
+            the name of each counter to its value. The "timings" member
+            maps the name of each histogram to a dictionary of the
+            number of latencies recorded ("count"), their total, mean,
+            least and greatest ("total_s", "mean_s", "min_s", "max_s"),
+            estimated percentiles ("p50_s" and so on), and the histogram
+            itself ("buckets", mapping the upper bound of each bucket,
+            in seconds, to its count).
+
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {name: (count, total, least, greatest, dict(buckets))
+                       for name, (count, total, least, greatest, buckets)
+                       in self._timings.items()}
+
+        result = {}
+        for name, (count, total, least, greatest, buckets) in timings.items():
+            summary = {'count': count, 'total_s': total,
+                       'mean_s': total / count, 'min_s': least,
+                       'max_s': greatest}
+            ordered = sorted(buckets.items())
+            for percentile in PERCENTILES:
+                rank = -(-count * percentile // 100)
+                seen = 0
+                for bucket, bucket_count in ordered:
+                    seen += bucket_count
+                    if seen >= rank:
+                        break
+                summary['p{}_s'.format(percentile)] = min(
+                    _bucket_limit(bucket), greatest)
+            summary['buckets'] = {_bucket_limit(bucket): bucket_count
+                                  for bucket, bucket_count in ordered}
+            result[name] = summary
+        return {'counters': counters, 'timings': result}
+
+    def reset(self):
+        """Discard everything recorded so far."""
+        with self._lock:
+            self._counters = {}
+            self._timings = {}
+
+
+def _bucket_limit(bucket):
+    """Get the upper bound of a histogram bucket, in seconds."""
+    return (1 << bucket) / 1e9
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+"""Stages of post-processing for generated strings.
+
+A generator's postprocessors attribute holds a list of stages, applied
+in order to every string it generates. Each stage works either on one
+string at a time, or on a whole batch of strings that share an output
+format, as generated by the NumPy engine of Rulegen.generate_many().
+
+"""
+# Copyright © 2015 Timothy Pederick.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+from collections import namedtuple
+
+# Optional imports.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# One piece of a batch of strings, all generated from the same output
+# format. The text of the piece in each string is texts[choices[n]], where
+# texts and choices are NumPy arrays (of Python objects and of integers).
+# The colname is as in the 2-tuples passed to Postprocessor.process(), and
+# prepared is what Postprocessor.prepare() made of texts, or None.
+Piece = namedtuple('Piece', 'texts choices colname prepared')
+
+
+class Postprocessor:
+    """A stage of post-processing.
+
+    Subclasses must override process(). Overriding process_batch() as
+    well makes batches faster, by working on the distinct texts of each
+    piece, rather than string by string; anything that depends only on
+    those texts can be worked out once per column, by prepare().
+
+    """
+    def process(self, result):
+        """Process one generated string.
+
+        Keyword arguments:
+            result -- A list of 2-tuples. Each tuple contains a string
+                and a column name (or None if the string came from a
+                literal).
+
+        Returns:
+            None (the result argument is modified in-place).
+
+        """
+        raise NotImplementedError
+
+    def prepare(self, texts):
+        """Precompute lookup tables for the texts of a piece.
+
+        The generator calls this once for each column of data (and each
+        literal) it looks up, and keeps the result until its database
+        is rebuilt. The default is to prepare nothing.
+
+        Keyword arguments:
+            texts -- A NumPy array of strings.
+
+        Returns:
+            Anything; it is passed on to process_batch() as the prepared
+            member of each Piece with these texts.
+
+        """
+        return None
+
+    def process_batch(self, pieces):
+        """Process a batch of strings that share an output format.
+
+        The default is to call process() on each string in turn.
+
+        Keyword arguments:
+            pieces -- A list of Piece instances, one for each piece of
+                the output format, in order.
+
+        Returns:
+            A list of Piece instances for the processed strings, one for
+            each of the given pieces, in the same order.
+
+        """
+        count = 0 if len(pieces) == 0 else len(pieces[0].choices)
+        columns = [numpy.empty(count, dtype=object) for _ in pieces]
+        for member in range(count):
+            result = [(piece.texts[piece.choices[member]], piece.colname)
+                      for piece in pieces]
+            self.process(result)
+            for column, (text, _) in zip(columns, result):
+                column[member] = text
+        choices = numpy.arange(count)
+        return [Piece(column, choices, piece.colname, None)
+                for column, piece in zip(columns, pieces)]
+
+
+class Elision(Postprocessor):
+    """Run pieces together, the way compound words are formed.
+
+    Where a piece starts with the letter that the one before it ends
+    with, the doubled letter is deleted. Where a piece ends with a
+    linking vowel, and the next starts with a vowel, the linking vowel
+    is dropped. (So "bio" + "ology" becomes "biology", and "neuro" +
+    "science" is unchanged.)
+
+        >>> elision = Elision()
+        >>> result = [('astro', None), ('oceanography', 'Field')]
+        >>> elision.process(result)
+        >>> ''.join(text for text, _ in result)
+        'astroceanography'
+
+    In a batch, the four ways that each text can be cut short are
+    prepared in advance, along with the letters at either end, so
+    every decision between two adjacent pieces is made for the whole
+    batch at once, by comparing arrays.
+
+    Attributes:
+        linking -- The linking vowel. The default is "o".
+        vowels -- The vowels. The default is "aeiou".
+
+    """
+    def __init__(self, linking='o', vowels='aeiou'):
+        """Initialise the stage.
+
+        Keyword arguments:
+            linking, vowels -- As the instance attributes.
+
+        """
+        self.linking = linking
+        self.vowels = vowels
+
+    def process(self, result):
+        """Delete doubled letters and drop linking vowels."""
+        previous_end = None
+        for n, (text, colname) in enumerate(result):
+            changed = False
+            # Does this string duplicate the last letter of the previous?
+            if text[:1] == previous_end:
+                changed = True
+                text = text[1:]
+
+            # Does the next string make this one drop its linking vowel?
+            if text[-1:] == self.linking and n + 1 < len(result):
+                next_text, _ = result[n + 1]
+                if next_text[:1] in self.vowels and next_text != '':
+                    changed = True
+                    text = text[:-1]
+
+            # Were any changes made?
+            if changed:
+                result[n] = (text, colname)
+            previous_end = text[-1:]
+
+    def prepare(self, texts):
+        """Cut each text short in every way, and note its end letters.
+
+        Returns:
+            A 4-tuple of NumPy arrays, each with a row per text. The
+            first holds the text cut in each of four ways, numbered as
+            two bits: 1 to delete the first letter, and 2 to drop the
+            last. The second holds the last letter after each cut, or an
+            empty string. The third holds whether the text ends with the
+            linking vowel, with and without its first letter deleted.
+            The last holds the first letter of each text.
+
+        """
+        variants = numpy.empty((len(texts), 4), dtype=object)
+        ends = numpy.empty((len(texts), 4), dtype=object)
+        linked = numpy.zeros((len(texts), 2), dtype=bool)
+        firsts = numpy.empty(len(texts), dtype=object)
+        for n, text in enumerate(texts):
+            for cut in range(4):
+                variant = text[cut & 1:]
+                if cut & 2:
+                    variant = variant[:-1]
+                variants[n, cut] = variant
+                ends[n, cut] = variant[-1:]
+            linked[n] = (text[-1:] == self.linking,
+                         text[1:][-1:] == self.linking)
+            firsts[n] = text[:1]
+        return variants, ends, linked, firsts
+
+    def process_batch(self, pieces):
+        """Delete doubled letters and drop linking vowels, in bulk."""
+        tables = [self.prepare(piece.texts) if piece.prepared is None else
+                  piece.prepared for piece in pieces]
+        firsts = [table[3][piece.choices]
+                  for piece, table in zip(pieces, tables)]
+        starts_vowel = [numpy.isin(first, list(self.vowels))
+                        for first in firsts]
+
+        processed = []
+        previous_end = None
+        for n, (piece, table) in enumerate(zip(pieces, tables)):
+            variants, ends, linked, _ = table
+            choices = piece.choices
+            cut = (numpy.zeros(len(choices), dtype=numpy.intp)
+                   if previous_end is None else
+                   (firsts[n] == previous_end) & (firsts[n] != ''))
+            if n + 1 < len(pieces):
+                drop = linked[choices, cut.astype(numpy.intp)]
+                cut = cut | (drop & starts_vowel[n + 1]) * 2
+            cut = cut.astype(numpy.intp)
+            previous_end = ends[choices, cut]
+            if cut.any():
+                piece = Piece(variants[choices, cut],
+                              numpy.arange(len(choices)), piece.colname,
+                              None)
+            processed.append(piece)
+        return processed
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
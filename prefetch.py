@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""Generate strings ahead of time, on a background thread.
+
+A Prefetcher wraps a Rulegen instance, keeping a buffer of strings that
+it has already generated, so that taking one is just a matter of popping
+it off the buffer. The buffer is refilled in batches, using the batch
+path of Rulegen.generate_many(), whenever it runs low.
+
+"""
+# Copyright © 2015 Timothy Pederick.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+from collections import deque
+import threading
+
+
+class Prefetcher:
+    """A buffer of generated strings, kept topped up in the background.
+
+    Once the number of strings in the buffer falls to the low watermark,
+    the background thread generates more, until the buffer is back up to
+    the high watermark. If the buffer is emptied before then, callers
+    wait for the next batch, and the thread carries on refilling it
+    regardless of the watermarks while anybody is waiting.
+
+    Use as a context manager, or call close() when finished. A
+    prefetcher can be shared between threads.
+
+    Attributes:
+        generator -- The Rulegen instance that generates the strings.
+            It should not be rebuilt while the prefetcher is open.
+        low, high -- The low and high watermarks.
+        batch_size -- The largest number of strings to generate in one
+            go, or None to refill the buffer all at once.
+
+    """
+    def __init__(self, generator, low=250, high=1000, batch_size=None):
+        """Start filling the buffer.
+
+        Keyword arguments:
+            generator, low, high, batch_size -- As the instance
+                attributes. The defaults are 250, 1000 and None.
+
+        Raises:
+            ValueError -- If low is negative, or not less than high.
+
+        """
+        if not 0 <= low < high:
+            raise ValueError('watermarks must satisfy 0 <= low < high')
+        self.generator = generator
+        self.low, self.high = low, high
+        self.batch_size = batch_size
+
+        self._buffer = deque(maxlen=high)
+        self._lock = threading.Lock()
+        # Callers wait for the buffer to be refilled; the thread waits for
+        # it to run low.
+        self._refilled = threading.Condition(self._lock)
+        self._drained = threading.Condition(self._lock)
+        self._waiting = 0
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._fill, daemon=True,
+            name='rulegen-prefetch-{}'.format(generator.data_prefix))
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        """Get the number of strings ready in the buffer."""
+        return len(self._buffer)
+
+    def generate(self):
+        """Take a generated string from the buffer.
+
+        Returns:
+            A string.
+
+        Raises:
+            RuntimeError -- If the prefetcher is closed.
+            Exception -- Whatever the generator raised, if it failed,
+                once the strings it generated before then are used up.
+
+        """
+        return self.generate_many(1)[0]
+
+    def generate_many(self, n):
+        """Take a number of generated strings from the buffer.
+
+        If there are not enough, this waits for more to be generated.
+
+        Keyword arguments:
+            n -- The number of strings.
+
+        Returns:
+            A list of strings.
+
+        Raises:
+            As for generate().
+
+        """
+        results = []
+        with self._lock:
+            while True:
+                while len(results) < n and len(self._buffer) > 0:
+                    results.append(self._buffer.popleft())
+                if len(self._buffer) <= self.low:
+                    self._drained.notify()
+                if len(results) == n:
+                    return results
+
+                if self._closed:
+                    raise RuntimeError('prefetcher is closed')
+                if self._error is not None:
+                    raise self._error
+                metrics = self.generator.metrics
+                if metrics.enabled:
+                    metrics.count('prefetch_misses')
+                self._waiting += 1
+                try:
+                    self._refilled.wait()
+                finally:
+                    self._waiting -= 1
+
+    def close(self):
+        """Stop refilling the buffer, and discard what is left in it.
+
+        This waits for the batch being generated, if any, to finish.
+
+        """
+        with self._lock:
+            self._closed = True
+            self._buffer.clear()
+            self._drained.notify()
+            self._refilled.notify_all()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _fill(self):
+        """Keep the buffer filled, until closed or the generator fails."""
+        refilling = True
+        try:
+            while True:
+                with self._lock:
+                    while True:
+                        if self._closed:
+                            return
+                        if len(self._buffer) >= self.high:
+                            refilling = False
+                        elif (len(self._buffer) <= self.low or
+                                self._waiting > 0):
+                            refilling = True
+                        if refilling:
+                            break
+                        self._drained.wait()
+                    wanted = self.high - len(self._buffer)
+                if self.batch_size is not None:
+                    wanted = min(wanted, self.batch_size)
+
+                results = self.generator.generate_many(wanted)
+                with self._lock:
+                    if self._closed:
+                        return
+                    self._buffer.extend(results)
+                    self._refilled.notify_all()
+        except Exception as err:
+            with self._lock:
+                self._error = err
+                self._refilled.notify_all()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""Compact in-memory storage of a generator's roots."""
+# Copyright © 2015 Timothy Pederick.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+from array import array
+from collections.abc import Sequence
+
+
+class RootStore:
+    """A column-oriented copy of a table of roots.
+
+    Tables of roots are mostly empty cells, so rather than keeping a
+    Python object for every cell, each column keeps only its non-empty
+    cells, as two arrays: the identifiers of their rows, and references
+    into a string table. The string table is shared by every column,
+    and holds each distinct value once, all joined into one string.
+    Boolean columns ("flags") keep one bit per row instead.
+
+        >>> store = RootStore(['Prefix', 'Noun', 'IsPlural'],
+        ...                   [(1, ['', 'cat', '0']),
+        ...                    (2, ['cat', '', '0']),
+        ...                    (3, ['', 'mice', '1'])],
+        ...                   flag_columns=['IsPlural'])
+        >>> ids, values = store.column_index('Noun')
+        >>> list(ids), list(values)
+        ([1, 3], ['cat', 'mice'])
+        >>> list(store.column_index('IsPlural')[1])
+        [False, False, True]
+        >>> list(store.rows())[1]
+        (2, ['cat', '', False])
+
+    Attributes:
+        headings -- A list of the column headings, not including the
+            row identifiers.
+        flag_columns -- A set of the headings of the Boolean columns.
+
+    """
+    def __init__(self, headings, rows, flag_columns=()):
+        """Build the store.
+
+        Keyword arguments:
+            headings -- As the instance attribute.
+            rows -- An iterable of 2-tuples, in ascending order of the
+                first element, which is a row identifier. The second is
+                a sequence of the cells in the row, one per heading.
+                Empty strings and None are treated as empty cells. Flag
+                cells may be Booleans, integers, or strings of digits.
+            flag_columns -- An iterable of the headings of the Boolean
+                columns. The default is an empty tuple.
+
+        """
+        self.headings = list(headings)
+        self.flag_columns = set(flag_columns)
+
+        strings, interned = [], {}
+        self._row_ids = array('q')
+        self._columns = {heading: (array('q'), array('q'))
+                         for heading in self.headings
+                         if heading not in self.flag_columns}
+        self._flags = {heading: bytearray() for heading in self.flag_columns}
+
+        columns = [(self._columns.get(heading), self._flags.get(heading))
+                   for heading in self.headings]
+        for row_id, cells in rows:
+            pos = len(self._row_ids)
+            self._row_ids.append(row_id)
+            for (column, flags), cell in zip(columns, cells):
+                if flags is not None:
+                    if pos % 8 == 0:
+                        flags.append(0)
+                    if _is_set(cell):
+                        flags[pos // 8] |= 1 << (pos % 8)
+                elif cell is not None and cell != '':
+                    ref = interned.get(cell)
+                    if ref is None:
+                        ref = interned[cell] = len(strings)
+                        strings.append(cell)
+                    column[0].append(row_id)
+                    column[1].append(ref)
+
+        self._offsets = array('q', [0])
+        for string in strings:
+            self._offsets.append(self._offsets[-1] + len(string))
+        self._strings = ''.join(strings)
+
+    def __len__(self):
+        """Get the number of rows."""
+        return len(self._row_ids)
+
+    def string(self, ref):
+        """Get a string from the string table by its reference."""
+        return self._strings[self._offsets[ref]:self._offsets[ref + 1]]
+
+    def column_index(self, colname):
+        """Get the non-empty values of a column.
+
+        For a flag column, every row is included, whether set or not.
+
+        Keyword arguments:
+            colname -- The heading of the column.
+
+        Returns:
+            A 2-tuple. The first element is an array of row identifiers,
+            in ascending order, and the second is a read-only sequence
+            of the values in those rows, in the same order.
+
+        Raises:
+            KeyError -- If there is no such column.
+
+        """
+        if colname in self._flags:
+            return self._row_ids, _FlagColumn(self._flags[colname],
+                                              len(self._row_ids))
+        ids, refs = self._columns[colname]
+        return ids, _TextColumn(self, refs)
+
+    def rows(self):
+        """Get the rows of the store.
+
+        Empty cells are given as empty strings, and flags as Booleans.
+
+        Yields:
+            2-tuples of a row identifier and a list of cells, one per
+            heading, as taken by the constructor.
+
+        """
+        columns = []
+        for heading in self.headings:
+            ids, values = self.column_index(heading)
+            if heading in self._flags:
+                columns.append(iter(values))
+            else:
+                columns.append(_fill_gaps(self._row_ids, ids, values))
+        for row_id in self._row_ids:
+            yield row_id, [next(column) for column in columns]
+
+
+class _TextColumn(Sequence):
+    """The values of a text column of a RootStore."""
+    def __init__(self, store, refs):
+        self._store = store
+        self._refs = refs
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return [self[n] for n in range(*pos.indices(len(self)))]
+        return self._store.string(self._refs[pos])
+
+
+class _FlagColumn(Sequence):
+    """The values of a flag column of a RootStore."""
+    def __init__(self, flags, length):
+        self._flags = flags
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return [self[n] for n in range(*pos.indices(len(self)))]
+        if pos < 0:
+            pos += self._length
+        if not 0 <= pos < self._length:
+            raise IndexError('flag index out of range')
+        return bool(self._flags[pos // 8] & (1 << (pos % 8)))
+
+
+def _is_set(cell):
+    """Interpret a flag cell as a Boolean."""
+    if isinstance(cell, str):
+        return cell.strip() != '' and int(cell) != 0
+    return bool(cell)
+
+
+def _fill_gaps(row_ids, ids, values):
+    """Yield a column's values for every row, with gaps as empty strings."""
+    pos = 0
+    for row_id in row_ids:
+        if pos < len(ids) and ids[pos] == row_id:
+            yield values[pos]
+            pos += 1
+        else:
+            yield ''
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
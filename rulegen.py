@@ -17,18 +17,44 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Standard library imports.
-from collections import namedtuple
+from array import array
+import asyncio
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain, islice
+from math import comb, factorial
 import csv
+import hashlib
 import os
 import os.path
 import random
 import sqlite3
-import types
+import sys
+import threading
+from time import perf_counter
+import weakref
+
+# Optional imports.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Local imports.
-from ruleparser import (all_terminals, parse_rules, parse_terminals, Literal,
-                        DBLookup)
+from atomicfile import replacing
+from instrumentation import Stats
+from postprocessing import Elision, Piece
+from rootstore import RootStore
+from ruleparser import (all_terminals, compile_terminals, count_derivations,
+                        count_lookup_sets, load_rules, DBLookup, INITIAL,
+                        TerminalSampler)
+
+# Compiled plans for formats that don't come from a "Results" table. Formats
+# drawn directly from a large ruleset may never repeat, so only keep some.
+_compile_terminals_cached = lru_cache(maxsize=4096)(compile_terminals)
 
 # Enable boolean handling in SQLite.
 sqlite3.register_adapter(bool, int)
@@ -44,12 +70,24 @@ class Rulegen:
 
     To generate strings, the generator connects to a SQLite database
     file on disk (creating it from the above files first if it does not
-    exist). This database has two tables, called by default "Roots" and
-    "Results", corresponding to the CSV and rules files respectively.
+    exist, and updating it if they have changed). This database has two
+    tables, called by default "Roots" and "Results", corresponding to
+    the CSV and rules files respectively.
 
     (As a result of this setup, it is possible for a generator to
     operate with only the database file.)
 
+    Each thread that uses the generator gets its own database
+    connection, opened lazily and kept open for reuse. Call close() to
+    release them all, or use the generator as a context manager.
+
+    A generator can be shared between threads. The state of each
+    string being generated belongs to that call alone, and everything
+    that is loaded lazily (the rules, the column headings and the
+    in-memory indexes) is loaded only once, under a lock. Rebuilding
+    the database, or closing the generator, while other threads are
+    generating from it is not supported, however.
+
     Class attributes:
         The following attributes set some defaults for the names and
         schemas of the database files. Override them in a subclass, or
@@ -65,6 +103,26 @@ class Rulegen:
             data.
         idcol_type -- The SQLite type declaration applicable to the
             above-mentioned *_idcol attributes.
+        sources_table -- The name of the table that records the source
+            files each table was built from.
+        sources_cols -- The names of the columns of that table, which
+            hold the name of each table and the size, modification time
+            and SHA-256 hash of its source file.
+        load_chunk_size -- The number of rows to insert at a time when
+            building the database.
+        formats_memory_limit -- Roughly the most memory, in bytes, to
+            spend on listing output formats when building the "Results"
+            table. Half of it goes on keeping the expansions of rules
+            other than <RESULT> (see ruleparser.all_terminals()), and
+            the rest on weeding out repeated formats. Beyond this,
+            rules are expanded again each time they are used, and
+            repeats are weeded out by a unique index on disk instead,
+            which is slower.
+        async_batch_size -- The largest number of strings generated in
+            one go by the asynchronous methods.
+        numpy_min_batch -- The smallest number of strings for which
+            generate_many() uses its NumPy engine, if NumPy is
+            installed.
 
     Instance attributes:
         data_prefix -- A default filename (minus the extension) to use
@@ -75,15 +133,36 @@ class Rulegen:
             rules, and database files.
         rules -- The parse tree for the rules file, as produced by the
             ruleparser module. Read-only.
+        use_index -- True if random lookups are served from an
+            in-memory index of each column, rather than by querying the
+            database every time.
+        direct_sampling -- True if output formats are drawn directly
+            from the parsed rules (see ruleparser.TerminalSampler),
+            rather than picked from the "Results" table. In this case,
+            the "Results" table is left empty when the database is built.
+        sampler -- The TerminalSampler for the rules file. Read-only.
+        postprocessors -- A list of postprocessing.Postprocessor
+            instances, applied in order to every generated string (see
+            postprocess()).
+        metrics -- An instrumentation.Stats instance, which records
+            counters and timings of the stages of generation and of
+            building the database, if enabled (see stats()).
 
     """
     roots_table, roots_idcol = 'Roots', 'RootID'
     results_table, results_idcol, results_datacol = ('Results', 'ResultID',
                                                      'Result')
     idcol_type = 'INTEGER PRIMARY KEY AUTOINCREMENT'
+    async_batch_size = 1000
+    sources_table = 'Sources'
+    sources_cols = ('TableName', 'Size', 'MTime', 'Hash')
+    load_chunk_size = 10000
+    formats_memory_limit = 64 << 20
+    numpy_min_batch = 100
 
     def __init__(self, data_prefix, data_dir=None, csvfile=None, rulefile=None,
-                 dbfile=None):
+                 dbfile=None, use_index=False, direct_sampling=False,
+                 postprocessors=()):
         """Initialise the generator.
 
         Keyword arguments:
@@ -93,6 +172,10 @@ class Rulegen:
             csvfile, rulefile, dbfile -- As the instance attributes. The
                 defaults are built from the above two parameters, with
                 extensions ".csv", ".rules", and ".db", respectively.
+            use_index, direct_sampling -- As the instance attributes.
+                The defaults are False.
+            postprocessors -- An iterable of the instance attribute's
+                members. The default is an empty tuple.
 
         """
         self.data_prefix = data_prefix
@@ -104,13 +187,66 @@ class Rulegen:
                                            (rulefile, '.rules'),
                                            (dbfile, '.db')))
 
-        self._rules = self._headings = self._seen_ids = None
+        self._rules = self._headings = None
+        self._sampler = self._csv_format = None
+        self.use_index = use_index
+        self.direct_sampling = direct_sampling
+        self.postprocessors = list(postprocessors)
+
+        # Guards lazy initialisation, and the opening and closing of
+        # database connections. It is reentrant because rebuilding the
+        # database (while connecting) closes connections and re-reads files.
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._conns = []
+        self._db_checked = False
+        self._queries = {}
+        self._index = {}
+        self._store = None
+        self._arrays = {}
+        self._prepared = {}
+        self._plans = {}
+
+        # Caches for counting and listing the output space.
+        self._space = None
+        self._id_sets = {}
+        self._column_class_counts = {}
+        self._completions = {}
+        self._row_classes = {}
+        self._choices = {}
+        self._value_rows = {}
+
+        self._executor = None
+        self._waiters = []
+        self._serving_waiters = None
+
+        self.metrics = Stats()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     @property
     def rules(self):
-        if self._rules is None:
-            self._rules = parse_rules(self.rulefile)
-        return self._rules
+        rules = self._rules
+        if rules is None:
+            with self._lock:
+                if self._rules is None:
+                    self._rules = load_rules(self.rulefile)
+                rules = self._rules
+        return rules
+
+    @property
+    def sampler(self):
+        sampler = self._sampler
+        if sampler is None:
+            with self._lock:
+                if self._sampler is None:
+                    self._sampler = TerminalSampler(self.rules)
+                sampler = self._sampler
+        return sampler
 
     def guess_type(self, heading):
         """Guess the SQLite type of a column based on its heading.
@@ -159,8 +295,10 @@ class Rulegen:
 
         """
         if self._headings is None:
-            # Call the CSV reader so that self._headings is set.
-            self.read_csv()
+            with self._lock:
+                if self._headings is None:
+                    # Call the CSV reader so that self._headings is set.
+                    self.read_csv()
 
         assert self._headings is not None
         headings = [self.roots_idcol] if with_id else []
@@ -177,38 +315,335 @@ class Rulegen:
             A list of named-tuple instances.
 
         """
-        with open(self.csvfile, encoding='utf-8') as file:
+        # Lazy evaluation of a generator causes problems when other methods
+        # need to use self._headings, so don't be a generator. Just return
+        # the results instead of yielding each one.
+        rows = self.iter_csv()
+        first_row = next(rows, None)
+
+        # Stick each line in a named tuple. Only make a new named-tuple type
+        # if the headings have changed since last time.
+        if (self._csv_format is None or
+                self._csv_format._fields != tuple(self._headings)):
+            self._csv_format = namedtuple('csv_format', self._headings)
+        return ([] if first_row is None else
+                [self._csv_format(*first_row)] +
+                [self._csv_format(*row) for row in rows])
+
+    def iter_csv(self):
+        """Read data from the CSV data file, one row at a time.
+
+        Note that the generator's column headings are not read until
+        iteration starts.
+
+        Yields:
+            Lists of strings.
+
+        """
+        with open(self.csvfile, encoding='utf-8', newline='') as file:
             reader = csv.reader(file)
             # Fetch the column headings from the first line. Don't include it
             # in the output!
             self._headings = next(reader)
+            yield from reader
 
-            # Stick each remaining line in a named tuple.
-            csv_format = namedtuple('csv_format', self._headings)
+    def connect(self):
+        """Get a connection to the SQLite database.
 
-            # Lazy evaluation of a generator causes problems when other
-            # methods need to use self._headings, so don't be a generator.
-            # Just return the results instead of yielding each one.
-            return list(csv_format(*row) for row in reader)
+        Each thread has a connection of its own, which is opened the
+        first time that thread needs it and then reused by all its later
+        lookups, until close() is called or the thread ends. Before the
+        first connection is opened, the database is built if it does not
+        exist, or brought up to date if its source files have changed
+        (see update_db()).
+
+        Returns:
+            A sqlite3.Connection instance.
+
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            with self._lock, self.metrics.timer('connect'):
+                if not self._db_checked:
+                    self.update_db()
+                    self._db_checked = True
+                # Connections are only used by the thread that opened them,
+                # but close() may be called from any thread.
+                conn = sqlite3.connect(self.dbfile,
+                                       detect_types=sqlite3.PARSE_DECLTYPES,
+                                       check_same_thread=False)
+                # A thread's local data is discarded when it ends, and its
+                # connection is closed along with it.
+                owner = _ThreadOwner()
+                self._conns = [closer for closer in self._conns
+                               if closer.alive]
+                self._conns.append(weakref.finalize(owner, conn.close))
+                self._local.owner = owner
+                self._local.conn = conn
+        return conn
+
+    def stats(self):
+        """Get the counters and timings recorded so far.
+
+        Recording is off by default; turn it on by setting the enabled
+        attribute of the generator's metrics attribute. Timings are kept
+        for each of these stages, as they happen:
+            connect -- Opening a database connection (including any
+                rebuilding of the database that it needs).
+            build_db -- Building the database from scratch.
+            update_db -- Checking that an existing database is up to
+                date, and rebuilding any stale tables.
+            build_table:<table> -- Building one table of the database.
+            read_csv -- Reading the CSV file into memory.
+            compile_terminals -- Compiling an output format into a plan.
+            select_format -- Choosing the output format of a string.
+            lookup:<column> -- Looking up a value from a column.
+            postprocess -- Post-processing a string.
+            generate -- Generating a whole string, one at a time.
+            generate_batch -- Generating a batch with NumPy.
+        The counters are "queries", for lookups that went to the
+        database, "rows_inserted", for rows written to it, and
+        "formats_spilled", for builds of the "Results" table that went
+        over its memory limit (see the class attribute). The
+        stats attribute of the ruleparser module covers parsing and
+        expanding rules.
+
+        Returns:
+            A dictionary, as from instrumentation.Stats.snapshot().
+
+        """
+        return self.metrics.snapshot()
+
+    def reset_stats(self):
+        """Discard the counters and timings recorded so far."""
+        self.metrics.reset()
+
+    def close(self):
+        """Close all connections to the SQLite database, if open.
+
+        The worker thread used by the asyncio methods is also stopped,
+        once it has finished any calls already waiting for it.
+
+        The generator remains usable; connections will be reopened
+        (and the worker thread restarted) when they are next needed,
+        after checking that the database is up to date.
+
+        """
+        with self._lock:
+            for closer in self._conns:
+                closer()
+            self._conns = []
+            # Forget every thread's connection at once.
+            self._local = threading.local()
+            self._db_checked = False
+            if self._executor is not None:
+                # Don't wait, in case this is the worker thread itself.
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def _forget(self, tables):
+        """Discard everything held in memory about some tables.
+
+        Keyword arguments:
+            tables -- The names of the tables that are being rebuilt.
+
+        """
+        # Don't hold a connection to the old database open while rebuilding
+        # it. It will be reopened on the next lookup.
+        self.close()
+        # Any index of the old data is out of date, and so is anything
+        # counted from it.
+        self._index = {key: index for key, index in self._index.items()
+                       if key[0] not in tables}
+        self._arrays = {key: arrays for key, arrays in self._arrays.items()
+                        if key[0] not in tables}
+        self._prepared = {}
+        if self.roots_table in tables:
+            self._store = None
+        self._space = None
+        self._id_sets, self._column_class_counts = {}, {}
+        self._completions, self._row_classes, self._choices = {}, {}, {}
+        self._value_rows = {}
+        if self.results_table in tables:
+            # So are the rules and the compiled plans of the old formats.
+            self._rules = self._sampler = None
+            self._plans = {}
 
     def build_db(self):
         """(Re)build the SQLite database."""
-        # Connect to the database file.
-        conn = sqlite3.connect(self.dbfile,
-                               detect_types=sqlite3.PARSE_DECLTYPES)
-        try:
-            # We need the CSV reader later, so let's call it now so that
-            # self._headings is set.
-            csv_rows = self.read_csv()
+        start = perf_counter() if self.metrics.enabled else None
+        self._forget({self.roots_table, self.results_table})
+
+        # Build the new database in a temporary file alongside the old one,
+        # then move it into place, so that nobody ever sees it half-built.
+        with replacing(self.dbfile, suffix='.db') as tempfile:
+            conn = sqlite3.connect(tempfile, isolation_level=None)
+            try:
+                cur = conn.cursor()
+                # Nothing else can be reading the temporary file, and if the
+                # build fails it's thrown away, so don't bother with a journal
+                # or with waiting for the disk.
+                cur.execute('PRAGMA journal_mode = OFF')
+                cur.execute('PRAGMA synchronous = OFF')
+                cur.execute('PRAGMA locking_mode = EXCLUSIVE')
+                cur.execute('BEGIN')
+
+                cur.execute('CREATE TABLE {!r}'
+                            ' ({!r} TEXT PRIMARY KEY'
+                            ', {!r} INTEGER'
+                            ', {!r} INTEGER'
+                            ', {!r} TEXT)'.format(self.sources_table,
+                                                  *self.sources_cols))
+                for table, filename in self._sources():
+                    with self.metrics.timer('build_table:' + table):
+                        self._build_table(cur, table)
+                    self._record_source(cur, table, filename)
+
+                cur.execute('COMMIT')
+            finally:
+                conn.close()
+        if start is not None:
+            self.metrics.record('build_db', perf_counter() - start)
+
+    def update_db(self):
+        """Bring the SQLite database up to date with its source files.
+
+        The database records the size, modification time and content
+        hash of the CSV and rules files that it was built from. If
+        either file has changed since, only the table built from it is
+        rebuilt. If the database does not exist at all, it is built
+        from scratch. Missing source files are ignored, so that a
+        generator can still operate with only the database file.
+
+        A database built for direct sampling has an empty "Results"
+        table, so a generator that doesn't sample directly rebuilds that
+        table, even if the rules file hasn't changed.
+
+        Returns:
+            A set of the names of the tables that were rebuilt.
+
+        """
+        if not os.path.isfile(self.dbfile):
+            self.build_db()
+            return {self.roots_table, self.results_table}
 
+        start = perf_counter() if self.metrics.enabled else None
+        conn = sqlite3.connect(self.dbfile, isolation_level=None)
+        try:
             cur = conn.cursor()
-            # Create or replace the tables.
-            cur.execute('DROP TABLE IF EXISTS {!r}'.format(self.roots_table))
-            cur.execute('DROP TABLE IF EXISTS {!r}'.format(self.results_table))
+            try:
+                recorded = {row[0]: row[1:] for row in
+                            cur.execute('SELECT t.{!r}, t.{!r}, t.{!r}, t.{!r}'
+                                        ' FROM {!r} t'.format(
+                                            *self.sources_cols,
+                                            self.sources_table))}
+            except sqlite3.OperationalError:
+                # This database predates source tracking.
+                recorded = None
+
+            # Was the "Results" table left empty for direct sampling?
+            unfilled = (not self.direct_sampling and
+                        cur.execute('SELECT 1 FROM {!r} LIMIT 1'.format(
+                            self.results_table)).fetchone() is None)
+
+            stale = []
+            for table, filename in self._sources():
+                if not os.path.isfile(filename):
+                    continue
+                fingerprint = (None if recorded is None or
+                               (unfilled and table == self.results_table)
+                               else recorded.get(table))
+                stat = os.stat(filename)
+                if (fingerprint is not None and
+                        fingerprint[:2] == (stat.st_size, stat.st_mtime_ns)):
+                    continue
+                if (fingerprint is not None and
+                        fingerprint[2] == _file_hash(filename)):
+                    # The file was touched, but not changed. Just note the
+                    # new size and time, so it needn't be hashed next time.
+                    self._record_source(cur, table, filename)
+                    continue
+                stale.append((table, filename))
+
+            if len(stale) > 0:
+                self._forget({table for table, _ in stale})
+                cur.execute('BEGIN IMMEDIATE')
+                if recorded is None:
+                    cur.execute('CREATE TABLE {!r}'
+                                ' ({!r} TEXT PRIMARY KEY'
+                                ', {!r} INTEGER'
+                                ', {!r} INTEGER'
+                                ', {!r} TEXT)'.format(self.sources_table,
+                                                      *self.sources_cols))
+                for table, filename in stale:
+                    cur.execute('DROP TABLE IF EXISTS {!r}'.format(table))
+                    with self.metrics.timer('build_table:' + table):
+                        self._build_table(cur, table)
+                    self._record_source(cur, table, filename)
+                cur.execute('COMMIT')
+            return {table for table, _ in stale}
+        finally:
+            conn.close()
+            if start is not None:
+                self.metrics.record('update_db', perf_counter() - start)
+
+    def _sources(self):
+        """List the tables of the database with their source files."""
+        return [(self.roots_table, self.csvfile),
+                (self.results_table, self.rulefile)]
+
+    def _record_source(self, cur, table, filename):
+        """Record the fingerprint of a table's source file.
+
+        Keyword arguments:
+            cur -- A database cursor.
+            table -- The name of the table built from the file.
+            filename -- The path and filename of the source file.
+
+        """
+        stat = os.stat(filename)
+        cur.execute('INSERT OR REPLACE INTO {!r} ({!r}, {!r}, {!r}, {!r})'
+                    ' VALUES (?, ?, ?, ?)'.format(self.sources_table,
+                                                  *self.sources_cols),
+                    (table, stat.st_size, stat.st_mtime_ns,
+                     _file_hash(filename)))
+
+    def _build_table(self, cur, table):
+        """Create one table of the database and fill it with data.
+
+        Keyword arguments:
+            cur -- A database cursor, inside a transaction.
+            table -- The name of the table; either the roots_table or
+                the results_table attribute.
+
+        """
+        if table == self.roots_table:
+            # We need the CSV reader to have read the headings before creating
+            # the table, so start reading it now.
+            csv_rows = self.iter_csv()
+            first_row = next(csv_rows, None)
+
             cur.execute('CREATE TABLE {!r} '
                         '({})'.format(self.roots_table,
                                       self.headings(with_id=True,
                                                     with_types=True)))
+
+            # Read in the CSV data and insert it into the table, numbering
+            # the rows as roots_store() does when it reads the CSV itself.
+            placeholders = ', '.join('?' for _ in range(len(self._headings) +
+                                                        1))
+            self._insert_chunks(cur,
+                                'INSERT INTO {!r} ({})'
+                                ' VALUES ({})'.format(self.roots_table,
+                                                      self.headings(
+                                                          with_id=True),
+                                                      placeholders),
+                                ([row_id] + row for row_id, row in
+                                 enumerate(chain(() if first_row is None
+                                                 else (first_row,),
+                                                 csv_rows), start=1)))
+        else:
+            assert table == self.results_table
             cur.execute('CREATE TABLE {!r}'
                         ' ({!r} {}'
                         ', {!r} TEXT)'.format(self.results_table,
@@ -216,34 +651,99 @@ class Rulegen:
                                               self.idcol_type,
                                               self.results_datacol))
 
-            # Read in the CSV data and insert it into the table.
-            cur.executemany('INSERT INTO {!r} ({})'
-                            ' VALUES ({})'.format(self.roots_table,
-                                                  self.headings(),
-                                                  ', '.join('?' for _ in
-                                                            self._headings)),
-                            csv_rows)
-            # Parse the rules and insert each result format into the table.
-            cur.executemany('INSERT INTO {!r} ({})'
-                            ' VALUES (?)'.format(self.results_table,
-                                                 self.results_datacol),
-                            # Stick each terminal sequence in a one-item tuple
-                            # to stop the string being interpreted as a
-                            # sequence of data values.
-                            ((result,) for result in
-                             all_terminals(self.rules)))
-
-            conn.commit()
-        finally:
-            conn.close()
+            # Parse the rules and insert each result format into the table,
+            # unless formats will be sampled straight from the rules.
+            if not self.direct_sampling:
+                expansions_limit = self.formats_memory_limit // 2
+                terminal_seqs = all_terminals(self.rules, unique=False,
+                                              memory_limit=expansions_limit)
+                self._insert_chunks(cur,
+                                    'INSERT INTO {!r} ({})'
+                                    ' VALUES (?)'.format(self.results_table,
+                                                         self.results_datacol),
+                                    # Stick each terminal sequence in a
+                                    # one-item tuple to stop the string being
+                                    # interpreted as a sequence of data values.
+                                    ((result,) for result in
+                                     self._unique_formats(
+                                         terminal_seqs,
+                                         self.formats_memory_limit -
+                                         expansions_limit)))
+
+                # If that stopped at the memory limit, weed out repeats in the
+                # rest with an index instead. The formats so far are unique,
+                # so the index can go on now.
+                result = next(terminal_seqs, None)
+                if result is not None:
+                    if self.metrics.enabled:
+                        self.metrics.count('formats_spilled')
+                    index = self.results_table + '_unique'
+                    cur.execute('CREATE UNIQUE INDEX {!r} ON {!r} '
+                                '({!r})'.format(index, self.results_table,
+                                                self.results_datacol))
+                    self._insert_chunks(cur,
+                                        'INSERT INTO {0!r} ({1!r})'
+                                        ' SELECT ? WHERE NOT EXISTS'
+                                        ' (SELECT 1 FROM {0!r} t'
+                                        ' WHERE t.{1!r} = ?)'.format(
+                                            self.results_table,
+                                            self.results_datacol),
+                                        ((result, result) for result in
+                                         chain((result,), terminal_seqs)))
+                    cur.execute('DROP INDEX {!r}'.format(index))
+
+    def _unique_formats(self, terminal_seqs, memory_limit):
+        """Weed out repeated output formats, within a memory limit.
+
+        Repeats are weeded out in memory, until the formats seen take up
+        more than the memory limit. Then this stops, leaving the rest
+        unread.
+
+        Keyword arguments:
+            terminal_seqs -- An iterator of output formats.
+            memory_limit -- Roughly the most memory to use, in bytes.
+
+        """
+        seen, size = set(), 0
+        for fmt in terminal_seqs:
+            if fmt not in seen:
+                seen.add(fmt)
+                # Allow for the set's hash table, as well as the string.
+                size += sys.getsizeof(fmt) + 32
+                yield fmt
+                if size > memory_limit:
+                    return
+
+    def _insert_chunks(self, cur, query, rows):
+        """Insert rows into the database in bounded-size chunks.
+
+        Keyword arguments:
+            cur -- A database cursor.
+            query -- A SQL INSERT statement.
+            rows -- An iterable of parameter sequences for the query.
+                This is consumed lazily, no more than the generator's
+                load_chunk_size attribute at a time.
 
-    def get_data(self, colname, table=None, idcol=None):
+        """
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, self.load_chunk_size))
+            if len(chunk) == 0:
+                break
+            cur.executemany(query, chunk)
+            if self.metrics.enabled:
+                self.metrics.count('rows_inserted', cur.rowcount)
+
+    def get_data(self, colname, table=None, idcol=None, seen_ids=None):
         """Get one random value from the database.
 
-        Internally, the generator's _seen_ids attribute is used to
-        ensure that successive calls to get_data() do not repeat rows.
-        This private attribute is set (and reset) by the generate()
-        method.
+        The generate() method passes the same seen_ids set to each of
+        its calls to get_data(), so that one string does not repeat
+        rows.
+
+        If the generator's use_index attribute is true, the value is
+        drawn from the column's in-memory index instead of by querying
+        the database.
 
         Keyword arguments:
             colname -- The database column name from which data is to be
@@ -256,53 +756,232 @@ class Rulegen:
                 roots_idcol attribute (or results_idcol, if the table
                 argument is supplied and is equal to the results_table
                 attribute).
+            seen_ids -- A set of row identifiers not to use. The
+                identifier of the row chosen is added to it. The default
+                is None, meaning that any row may be used.
 
         Returns:
             A string.
 
         """
-        if not os.path.isfile(self.dbfile):
-            self.build_db()
+        return self.get_row(colname, table, idcol, seen_ids)[1]
+
+    def get_row(self, colname, table=None, idcol=None, seen_ids=None):
+        """Get one random value from the database, with its row ID.
+
+        This works exactly as get_data() does, taking the same
+        arguments, but also returns the unique identifier of the row
+        that the value came from.
 
+        Returns:
+            A 2-tuple of the row identifier and the value.
+
+        """
+        start = perf_counter() if self.metrics.enabled else None
         if table is None:
             table = self.roots_table
         if idcol is None:
             idcol = (self.results_idcol if table == self.results_table else
                      self.roots_idcol)
 
-        conn = sqlite3.connect(self.dbfile,
-                               detect_types=sqlite3.PARSE_DECLTYPES)
-        try:
-            cur = conn.cursor()
+        if self.use_index:
+            ids, values = self.column_index(colname, table, idcol)
+            pos = self._random_position(ids, seen_ids)
+            if seen_ids is not None:
+                seen_ids.add(ids[pos])
+            row = ids[pos], values[pos]
+        else:
+            # Avoid repeats, if we're keeping track of them.
+            values = [] if seen_ids is None else list(seen_ids)
+            query = self._lookup_query(table, colname, idcol, len(values))
+            row = self.connect().execute(query, values).fetchone()
+            if start is not None:
+                self.metrics.count('queries')
+            if row is None:
+                raise LookupError('no unused values in column '
+                                  '{!r}'.format(colname))
+            if seen_ids is not None:
+                seen_ids.add(row[0])
+            # Don't commit, because nothing (should have) changed!
+
+        if start is not None:
+            self.metrics.record('lookup:' + colname, perf_counter() - start)
+        return row
+
+    def column_index(self, colname, table=None, idcol=None):
+        """Get the in-memory index of a database column.
+
+        The index holds every non-empty value in the column, together
+        with the unique identifier of its row. It is loaded from the
+        database the first time it is requested, and discarded when the
+        database is rebuilt. Columns of the "Roots" table are served
+        from its compact copy (see roots_store()) instead.
+
+        Keyword arguments:
+            colname, table, idcol -- As for get_data().
+
+        Returns:
+            A 2-tuple. The first element is an array of row identifiers,
+            and the second is a sequence of the values in those rows, in
+            the same order.
+
+        """
+        if table is None:
+            table = self.roots_table
+        if idcol is None:
+            idcol = (self.results_idcol if table == self.results_table else
+                     self.roots_idcol)
+        if table == self.roots_table and idcol == self.roots_idcol:
+            return self.roots_store().column_index(colname)
+
+        key = (table, colname)
+        index = self._index.get(key)
+        if index is None:
+            with self._lock:
+                index = self._index.get(key)
+                if index is None:
+                    index = self._index[key] = self._load_index(table, colname,
+                                                                idcol)
+        return index
+
+    def roots_store(self):
+        """Get the compact in-memory copy of the "Roots" table.
+
+        The copy is loaded the first time it is requested, and discarded
+        when the table is rebuilt. Until the generator has connected to
+        the database, it is read straight from the CSV file, which the
+        database is then built from; after that, from the database.
+
+        Returns:
+            A rootstore.RootStore instance.
+
+        """
+        store = self._store
+        if store is None:
+            with self._lock:
+                if (self._store is None and not self._db_checked and
+                        os.path.isfile(self.csvfile)):
+                    csv_rows = self.iter_csv()
+                    first_row = next(csv_rows, None)
+                    with self.metrics.timer('read_csv'):
+                        self._store = self._make_store(
+                            self._headings,
+                            enumerate(chain(() if first_row is None else
+                                            (first_row,), csv_rows),
+                                      start=1))
+                if self._store is None:
+                    cur = self.connect().execute(
+                        'SELECT * FROM {!r} t'
+                        ' ORDER BY t.{!r}'.format(self.roots_table,
+                                                  self.roots_idcol))
+                    headings = [column[0] for column in cur.description]
+                    id_pos = headings.index(self.roots_idcol)
+                    del headings[id_pos]
+                    self._store = self._make_store(
+                        headings, ((row[id_pos],
+                                    row[:id_pos] + row[id_pos + 1:])
+                                   for row in cur))
+                store = self._store
+        return store
+
+    def _make_store(self, headings, rows):
+        """Build a RootStore, finding the flag columns by their type.
+
+        Keyword arguments:
+            headings, rows -- As for the RootStore constructor.
+
+        Returns:
+            A rootstore.RootStore instance.
+
+        """
+        return RootStore(headings, rows,
+                         flag_columns=[heading for heading in headings
+                                       if self.guess_type(heading).startswith(
+                                           'BOOLEAN')])
+
+    def _load_index(self, table, colname, idcol):
+        """Read a column and its row identifiers from the database.
+
+        Keyword arguments:
+            table, colname, idcol -- As for get_data().
+
+        Returns:
+            A 2-tuple, as from column_index().
+
+        """
+        cur = self.connect().execute('SELECT t.{2!r}, t.{1!r}'
+                                     ' FROM {0!r} t'
+                                     ' WHERE t.{1!r} IS NOT NULL'
+                                     '  AND t.{1!r} != ""'
+                                     ' ORDER BY t.{2!r}'.format(table,
+                                                                colname,
+                                                                idcol))
+        ids, values = array('q'), []
+        for row_id, value in cur:
+            ids.append(row_id)
+            values.append(value)
+        return ids, values
+
+    def _random_position(self, ids, seen_ids=None):
+        """Pick a random position in an index, avoiding seen rows.
+
+        Keyword arguments:
+            ids -- An array of row identifiers, as from column_index().
+            seen_ids -- A set of row identifiers to avoid, or None.
+
+        Returns:
+            An integer index into the ids array.
+
+        """
+        if len(ids) == 0:
+            raise LookupError('no values to choose from')
+        pos = random.randrange(len(ids))
+        if seen_ids is None or ids[pos] not in seen_ids:
+            return pos
+
+        # Only a handful of rows are ever seen in one string, so it's almost
+        # always enough to try again. If that keeps failing, the column must
+        # be nearly used up; just pick from what's left.
+        for _ in range(len(seen_ids)):
+            pos = random.randrange(len(ids))
+            if ids[pos] not in seen_ids:
+                return pos
+        unseen = [pos for pos, row_id in enumerate(ids)
+                  if row_id not in seen_ids]
+        if len(unseen) == 0:
+            raise LookupError('no unused values to choose from')
+        return random.choice(unseen)
+
+    def _lookup_query(self, table, colname, idcol, avoid_count):
+        """Get the SQL query text for a random lookup.
+
+        Query strings are built once and cached, so that repeated
+        lookups reuse the same text (and therefore the same prepared
+        statement in the sqlite3 module's statement cache).
+
+        Keyword arguments:
+            table, colname, idcol -- As for get_data().
+            avoid_count -- The number of row identifiers that the query
+                should exclude.
+
+        Returns:
+            A string containing a SQL SELECT statement.
+
+        """
+        key = (table, colname, idcol, avoid_count)
+        query = self._queries.get(key)
+        if query is None:
             # Build a WHERE clause that avoids repeats.
-            values = []
-            select_addendum = where_addenda = ''
-            if self._seen_ids is not None:
-                select_addendum = ', t.{!r}'.format(idcol)
-                avoid_this = ' AND t.{!r} != ?'.format(idcol)
-                avoids = []
-                for seen_id in self._seen_ids:
-                    avoids.append(avoid_this)
-                    values.append(seen_id)
-                if len(avoids) > 0:
-                    where_addenda = ''.join(avoids)
-            query = ('SELECT t.{1!r}{2}'
+            where_addenda = ' AND t.{!r} != ?'.format(idcol) * avoid_count
+            query = ('SELECT t.{2!r}, t.{1!r}'
                      ' FROM {0!r} t'
                      ' WHERE t.{1!r} IS NOT NULL'
                      '  AND t.{1!r} != ""{3}'
                      ' ORDER BY random()'
-                     ' LIMIT 1'.format(table, colname,
-                                       select_addendum, where_addenda))
-            cur.execute(query, values)
-            row = cur.fetchone()
-            if self._seen_ids is not None:
-                self._seen_ids.add(row[1])
-
-            # We're finished with the connection... but don't commit, because
-            # nothing (should have) changed!
-            return row[0]
-        finally:
-            conn.close()
+                     ' LIMIT 1'.format(table, colname, idcol,
+                                       where_addenda))
+            self._queries[key] = query
+        return query
 
     def generate(self):
         """Generate a random string according to the generator rules.
@@ -311,40 +990,1066 @@ class Rulegen:
             A string.
 
         """
-        # Select a random output format. Don't save seen data rows, yet.
-        self._seen_ids = None
-        fmt = self.get_data(self.results_datacol, self.results_table,
-                            self.results_idcol)
+        start = perf_counter() if self.metrics.enabled else None
+
+        # Select a random output format.
+        if self.direct_sampling:
+            plan = self.plan(self.sampler.sample())
+        else:
+            result_id, fmt = self.get_row(self.results_datacol,
+                                          self.results_table,
+                                          self.results_idcol)
+            plan = self.plan(fmt, result_id)
+        if start is not None:
+            self.metrics.record('select_format', perf_counter() - start)
+
+        result = self._fill_plan(plan, self.get_data)
+        if start is not None:
+            self.metrics.record('generate', perf_counter() - start)
+        return result
+
+    def iter_generate(self, n=None):
+        """Generate random strings according to the generator rules.
+
+        This is equivalent to calling generate() repeatedly, but the
+        setup is shared by the whole batch: the output formats and the
+        roots are fetched from the database in bulk (into the in-memory
+        indexes used by column_index()).
+
+        Keyword arguments:
+            n -- The number of strings to generate. The default is None,
+                meaning to keep generating indefinitely.
+
+        Yields:
+            Strings.
+
+        """
+        if self.direct_sampling:
+            sampler = self.sampler
+
+            def next_plan():
+                return self.plan(sampler.sample())
+        else:
+            format_ids, formats = self.column_index(self.results_datacol,
+                                                    self.results_table,
+                                                    self.results_idcol)
+
+            def next_plan():
+                pos = self._random_position(format_ids)
+                return self.plan(formats[pos], format_ids[pos])
+
+        metrics = self.metrics
+
+        def lookup(colname, seen_ids):
+            start = perf_counter() if metrics.enabled else None
+            ids, values = self.column_index(colname)
+            pos = self._random_position(ids, seen_ids)
+            seen_ids.add(ids[pos])
+            if start is not None:
+                metrics.record('lookup:' + colname, perf_counter() - start)
+            return values[pos]
+
+        generated = 0
+        while n is None or generated < n:
+            start = perf_counter() if metrics.enabled else None
+            plan = next_plan()
+            if start is not None:
+                metrics.record('select_format', perf_counter() - start)
+            result = self._fill_plan(plan, lookup)
+            if start is not None:
+                metrics.record('generate', perf_counter() - start)
+            yield result
+            generated += 1
+
+    def generate_many(self, n):
+        """Generate a number of random strings.
+
+        See iter_generate() for details. If NumPy is installed and n is
+        at least the generator's numpy_min_batch attribute, the batch
+        is generated by a faster engine instead, with the same
+        distribution of results (see _generate_batch()). The two engines
+        draw their random numbers differently, so the same seed gives
+        different strings from each.
+
+        Keyword arguments:
+            n -- The number of strings to generate.
+
+        Returns:
+            A list of strings.
+
+        """
+        if numpy is not None and n >= self.numpy_min_batch:
+            with self.metrics.timer('generate_batch'):
+                return self._generate_batch(n)
+        return list(self.iter_generate(n))
+
+    def _generate_batch(self, n):
+        """Generate a number of random strings, using NumPy.
+
+        The random choices for the whole batch are drawn at once. First
+        the output formats are picked. Then, for all the strings that
+        share a format, the rows for each lookup in turn are picked
+        together, and any that repeat an earlier row of the same string
+        are redrawn together, until none do. Strings are put together
+        only at the end, and only passed through postprocess() one at a
+        time if the generator overrides it.
+
+        NumPy's random numbers are seeded from the random module, so
+        seeding that makes the output repeatable here too.
+
+        Keyword arguments:
+            n -- The number of strings to generate.
+
+        Returns:
+            A list of strings.
+
+        """
+        rng = numpy.random.default_rng(random.getrandbits(64))
+
+        # Group the strings by output format.
+        if self.direct_sampling:
+            sampler = self.sampler
+            grouped = {}
+            for member in range(n):
+                grouped.setdefault(self.plan(sampler.sample()),
+                                   []).append(member)
+            groups = [(plan, numpy.array(members))
+                      for plan, members in grouped.items()]
+        else:
+            format_ids, formats = self.column_index(self.results_datacol,
+                                                    self.results_table,
+                                                    self.results_idcol)
+            if len(format_ids) == 0:
+                raise LookupError('no values to choose from')
+            chosen = rng.integers(len(format_ids), size=n)
+            order = numpy.argsort(chosen, kind='stable')
+            positions, starts = numpy.unique(chosen[order], return_index=True)
+            groups = [(self.plan(formats[pos], format_ids[pos]), members)
+                      for pos, members in zip(positions.tolist(),
+                                              numpy.split(order,
+                                                          starts[1:]))]
+
+        pipeline = (getattr(self.postprocess, '__func__', None) is
+                    Rulegen.postprocess)
+        output = numpy.empty(n, dtype=object)
+        for plan, members in groups:
+            count = len(members)
+            drawn, pieces, sources = [], [], []
+            for text, colname in plan:
+                if colname is None:
+                    texts = numpy.empty(1, dtype=object)
+                    texts[0] = text
+                    positions = numpy.zeros(count, dtype=numpy.intp)
+                    key = (None, text)
+                else:
+                    ids, texts = self._column_arrays(colname)
+                    positions = self._draw_unseen(rng, ids, drawn, count)
+                    drawn.append(ids[positions])
+                    key = (self.roots_table, colname)
+                pieces.append(Piece(texts, positions, colname, None))
+                sources.append((texts, key))
+
+            if pipeline:
+                # Run the whole batch through each stage of postprocessing,
+                # giving each the tables it prepared earlier for any piece
+                # that earlier stages left unchanged.
+                start = perf_counter() if self.metrics.enabled else None
+                for stage in self.postprocessors:
+                    pieces = stage.process_batch(
+                        [piece._replace(prepared=(
+                            self._prepare(stage, key, texts)
+                            if piece.texts is texts else None))
+                         for piece, (texts, key) in zip(pieces, sources)])
+                if start is not None and len(self.postprocessors) > 0:
+                    self.metrics.record('postprocess_batch',
+                                        perf_counter() - start)
+                strings = numpy.full(count, '', dtype=object)
+                for piece in pieces:
+                    strings = strings + piece.texts[piece.choices]
+            else:
+                # The postprocess() method has been overridden, so it can
+                # only be called one string at a time.
+                strings = numpy.empty(count, dtype=object)
+                for member in range(count):
+                    result = [(piece.texts[piece.choices[member]],
+                               piece.colname) for piece in pieces]
+                    self.postprocess(result)
+                    strings[member] = ''.join(text for text, _ in result)
+            output[members] = strings
+        return output.tolist()
+
+    def _prepare(self, stage, key, texts):
+        """Get a postprocessing stage's tables for a batch Piece.
+
+        These are made by the stage's prepare() method the first time
+        each column (or literal) is used, and cached until the database
+        is rebuilt.
+
+        Keyword arguments:
+            stage -- A postprocessing.Postprocessor instance.
+            key -- A 2-tuple identifying the texts: a table name and a
+                column name, or None and the text of a literal.
+            texts -- A NumPy array of the texts.
+
+        Returns:
+            The prepared tables.
+
+        """
+        key = (stage,) + key
+        prepared = self._prepared.get(key)
+        if prepared is None:
+            prepared = self._prepared[key] = stage.prepare(texts)
+        return prepared
+
+    def _draw_unseen(self, rng, ids, drawn, count):
+        """Pick random rows for a batch of lookups, avoiding seen rows.
+
+        This is the batch counterpart of _random_position().
+
+        Keyword arguments:
+            rng -- A numpy.random.Generator instance.
+            ids -- A NumPy array of row identifiers, as from
+                _column_arrays().
+            drawn -- A list of NumPy arrays, each holding the row
+                identifiers already used by each string in the batch.
+            count -- The number of strings in the batch.
+
+        Returns:
+            A NumPy array of positions in the ids array, one per string.
+
+        """
+        if len(ids) == 0:
+            raise LookupError('no values to choose from')
+        positions = rng.integers(len(ids), size=count)
+
+        # As in _random_position(), a few tries is almost always enough. If
+        # not, the column must be nearly used up, so fall back on that.
+        pending = numpy.arange(count)
+        for _ in range(32):
+            chosen = ids[positions[pending]]
+            clash = numpy.zeros(len(pending), dtype=bool)
+            for earlier in drawn:
+                clash |= earlier[pending] == chosen
+            pending = pending[clash]
+            if len(pending) == 0:
+                return positions
+            positions[pending] = rng.integers(len(ids), size=len(pending))
+        for member in pending.tolist():
+            positions[member] = self._random_position(
+                ids, {int(earlier[member]) for earlier in drawn})
+        return positions
+
+    def _column_arrays(self, colname, table=None, idcol=None):
+        """Get NumPy copies of the in-memory index of a column.
+
+        Keyword arguments:
+            colname, table, idcol -- As for get_data().
+
+        Returns:
+            A 2-tuple of NumPy arrays, of the row identifiers and the
+            values (as Python objects), as from column_index().
+
+        """
+        if table is None:
+            table = self.roots_table
+        key = (table, colname)
+        arrays = self._arrays.get(key)
+        if arrays is None:
+            ids, values = self.column_index(colname, table, idcol)
+            values_array = numpy.empty(len(values), dtype=object)
+            values_array[:] = list(values)
+            arrays = self._arrays[key] = (numpy.array(ids, dtype=numpy.int64),
+                                          values_array)
+        return arrays
+
+    def _run_in_executor(self, func, *args):
+        """Run a blocking call on the generator's worker thread.
+
+        Each generator has a single worker thread of its own, so calls
+        from coroutines are carried out one at a time, in order. The
+        thread is started when first needed, and stopped by close().
+
+        Returns:
+            An awaitable for the result of the call.
+
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=1,
+                    thread_name_prefix='rulegen-{}'.format(self.data_prefix))
+            return asyncio.get_running_loop().run_in_executor(
+                self._executor, func, *args)
+
+    async def agenerate(self):
+        """Generate a random string, without blocking the event loop.
+
+        This is the asynchronous counterpart of generate(). The work is
+        done on the generator's worker thread, using the batch path of
+        iter_generate(). Callers that are waiting at the same time
+        share batches: while one batch is being generated, all new
+        callers queue up, and are then served by the next batch (of no
+        more than async_batch_size strings). Cancelling the call just
+        drops its place in the queue.
+
+        Note that the queue belongs to one event loop at a time.
+
+        Returns:
+            A string.
+
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        if self._serving_waiters is None:
+            self._serving_waiters = asyncio.ensure_future(
+                self._serve_waiters())
+        return await waiter
+
+    async def _serve_waiters(self):
+        """Generate strings for agenerate() callers, in batches."""
+        try:
+            while len(self._waiters) > 0:
+                batch = self._waiters[:self.async_batch_size]
+                del self._waiters[:self.async_batch_size]
+                batch = [waiter for waiter in batch if not waiter.done()]
+                if len(batch) == 0:
+                    continue
+                try:
+                    results = await self._run_in_executor(self.generate_many,
+                                                          len(batch))
+                except Exception as err:
+                    for waiter in batch:
+                        if not waiter.done():
+                            waiter.set_exception(err)
+                else:
+                    for waiter, result in zip(batch, results):
+                        if not waiter.done():
+                            waiter.set_result(result)
+        finally:
+            self._serving_waiters = None
+
+    async def aiter_generate(self, n=None, batch_size=None):
+        """Generate random strings, without blocking the event loop.
+
+        This is the asynchronous counterpart of iter_generate(), for use
+        with "async for". Strings are generated in batches on the
+        generator's worker thread. One batch is prepared ahead while
+        the current one is consumed, and no more, so a slow consumer
+        holds up generation rather than letting it pile up. If the
+        iteration is abandoned, the batch being prepared is discarded.
+
+        Keyword arguments:
+            n -- The number of strings to generate. The default is None,
+                meaning to keep generating indefinitely.
+            batch_size -- The number of strings in each batch. The
+                default is the generator's async_batch_size attribute.
+
+        Yields:
+            Strings.
+
+        """
+        if batch_size is None:
+            batch_size = self.async_batch_size
+
+        def next_batch(remaining):
+            return (None if remaining == 0 else
+                    asyncio.ensure_future(self._run_in_executor(
+                        self.generate_many,
+                        batch_size if remaining is None else
+                        min(batch_size, remaining))))
+
+        remaining = n
+        pending = next_batch(remaining)
+        try:
+            while pending is not None:
+                batch = await pending
+                if remaining is not None:
+                    remaining -= len(batch)
+                pending = next_batch(remaining)
+                for result in batch:
+                    yield result
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    def plan(self, fmt, result_id=None):
+        """Get the compiled generation plan for an output format.
+
+        Plans are compiled by the ruleparser.compile_terminals()
+        function the first time each format is used, and cached until
+        the database is rebuilt.
+
+        Keyword arguments:
+            fmt -- The output format.
+            result_id -- The unique identifier of the format's row in
+                the "Results" table, if it came from there. Plans are
+                cached by this identifier if given; if not, a limited
+                number of recently used formats are cached instead.
+
+        Returns:
+            A tuple of 2-tuples, as from compile_terminals().
+
+        """
+        if result_id is None:
+            return _compile_terminals_cached(fmt)
+
+        plan = self._plans.get(result_id)
+        if plan is None:
+            with self.metrics.timer('compile_terminals'):
+                plan = self._plans[result_id] = compile_terminals(fmt)
+        return plan
+
+    def output_space_size(self, upper_bound=False):
+        r"""Count the possible outputs of the generator.
+
+        This is the number of distinct combinations of an output format
+        and the rows of the "Roots" table used to fill it in, given that
+        no row is used twice in one output. (Different combinations can
+        still happen to produce the same string.)
+
+        Neither count needs the database. The exact count is worked out
+        from how many output formats look up each combination of
+        columns, as counted from the rules (see
+        ruleparser.count_lookup_sets()). Only if the rules are too
+        complex to count that way is every format listed, as for
+        unrank().
+
+        The "Results" table never holds an empty output format, so an
+        empty string only counts as an output with direct sampling:
+            >>> import os.path, tempfile
+            >>> data_dir = tempfile.TemporaryDirectory()
+            >>> def write(filename, text):
+            ...     with open(os.path.join(data_dir.name, filename), 'w',
+            ...               encoding='utf-8') as file:
+            ...         file.write(text)
+            >>> write('maybe.csv', 'Noun\ncat\ndog\n')
+            >>> write('maybe.rules', '<RESULT> = ?[Noun]\n')
+            >>> with Rulegen('maybe', data_dir.name) as maybe:
+            ...     size = maybe.output_space_size()
+            ...     outputs = sorted(maybe.iter_outputs())
+            >>> with Rulegen('maybe', data_dir.name,
+            ...              direct_sampling=True) as maybe:
+            ...     direct_size = maybe.output_space_size()
+            ...     direct_outputs = sorted(maybe.iter_outputs())
+            >>> data_dir.cleanup()
+            >>> size, outputs
+            (2, ['cat', 'dog'])
+            >>> direct_size, direct_outputs
+            (3, ['', 'cat', 'dog'])
+
+        Keyword arguments:
+            upper_bound -- True if only a cheap upper bound is wanted.
+                This is counted straight from the rules, weighting each
+                database lookup by the number of values in its column,
+                without listing the output formats or allowing for
+                repeat avoidance. The default is False.
+
+        Returns:
+            An integer.
+
+        """
+        if upper_bound:
+            colnames = {token.content for production in self.rules.values()
+                        for token in production
+                        if isinstance(token, DBLookup)}
+            return count_derivations(self.rules,
+                                     {colname:
+                                      len(self.column_index(colname)[0])
+                                      for colname in colnames})[INITIAL]
+
+        if self._space is None and os.path.isfile(self.rulefile):
+            lookup_sets = count_lookup_sets(
+                self.rules, nonempty=not self.direct_sampling)
+            if lookup_sets is not None:
+                return sum(count * self._distinct_row_count(colnames)
+                           for colnames, count in lookup_sets.items())
+        cumulative = self._output_space()[1]
+        return cumulative[-1] if len(cumulative) > 0 else 0
+
+    def session(self, formats=False, on_exhausted='reshuffle'):
+        """Start a run of generations that doesn't reuse roots.
+
+        See the Session class for details.
+
+        Keyword arguments:
+            formats, on_exhausted -- As for Session.
+
+        Returns:
+            A Session instance.
+
+        """
+        return Session(self, formats, on_exhausted)
+
+    def generate_unique(self, n, seed=None):
+        """Generate a number of distinct random strings.
+
+        Rather than generating strings and throwing away repeats, this
+        walks the whole output space (see output_space_size()) once, in
+        an order shuffled as by iter_outputs(), so that no combination
+        of an output format and roots is ever tried twice and the cost
+        of each string does not grow as n approaches the size of the
+        space.
+
+        Different combinations can happen to produce the same string.
+        When that happens, the repeat is skipped and the walk goes on.
+
+        Keyword arguments:
+            n -- The number of strings to generate.
+            seed -- The seed for the shuffle, as for iter_outputs(). The
+                default is None, meaning a seed drawn from the random
+                module.
+
+        Returns:
+            A list of strings, in random order.
+
+        Raises:
+            ValueError -- If n is larger than the output space.
+            LookupError -- If there turn out to be fewer than n distinct
+                strings in the output space.
+
+        """
+        size = self.output_space_size()
+        if not 0 <= n <= size:
+            raise ValueError('cannot generate {} unique strings; the '
+                             'generator only has {} possible '
+                             'outputs'.format(n, size))
+
+        results = list(islice(self._iter_unique(seed), n))
+        if len(results) < n:
+            raise LookupError('the generator only has {} distinct '
+                              'outputs'.format(len(results)))
+        return results
+
+    def _iter_unique(self, seed=None):
+        """Generate the distinct outputs, in a shuffled order.
+
+        Keyword arguments:
+            seed -- As for generate_unique().
+
+        Yields:
+            Strings, none of them twice, until the output space runs out.
+
+        """
+        if seed is None:
+            seed = random.randrange(2 ** 64)
+        seen = set()
+        for result in self.iter_outputs(seed=seed):
+            if result not in seen:
+                seen.add(result)
+                yield result
+
+    def unrank(self, index):
+        """Generate the output with a given position in the output space.
+
+        The output space (see output_space_size()) is put in a fixed
+        order: by output format, in the order of the "Results" table
+        (or of ruleparser.all_terminals(), with direct sampling), and
+        then by the rows used to fill in each format. The order only
+        changes if the database is rebuilt, so generators on different
+        machines with the same database agree on it, and can share out
+        the work of generating without any further coordination. See
+        iter_outputs().
+
+        Keyword arguments:
+            index -- An integer from 0 up to (but not including) the
+                result of output_space_size().
+
+        Returns:
+            A string.
+
+        Raises:
+            IndexError -- If the index is out of range.
+
+        """
+        formats, cumulative = self._output_space()
+        format_number = bisect_right(cumulative, index)
+        if index < 0 or format_number == len(formats):
+            raise IndexError('output index out of range')
+        if format_number > 0:
+            index -= cumulative[format_number - 1]
+        plan, positions, colnames = formats[format_number]
+
+        values = {}
+        for pos, colname, row_id in zip(positions, colnames,
+                                        self._unrank_rows(colnames, index)):
+            ids, column = self.column_index(colname)
+            values[pos] = column[bisect_left(ids, row_id)]
+        values = iter([values[pos] for pos in sorted(values)])
+        return self._fill_plan(plan,
+                               lambda colname, seen_ids: next(values))
+
+    def rank(self, result):
+        """Find the position of an output in the output space.
+
+        This is the inverse of unrank(), but only for generators whose
+        post-processing leaves the text unchanged. Strings are matched
+        against the output formats as they are before post-processing,
+        so any string that a postprocessor altered cannot be found. For
+        instance, the academia generator's Elision stage changes most
+        of its output, and rank() raises ValueError for those strings.
+        If different combinations of format and roots give the same
+        string, the position of one of them is returned.
+
+        Keyword arguments:
+            result -- A string.
+
+        Returns:
+            An integer.
+
+        Raises:
+            ValueError -- If the string could not be found, including
+                when post-processing changed it.
+
+        """
+        formats, cumulative = self._output_space()
+        for format_number, (plan, positions, colnames) in enumerate(formats):
+            rows = self._match_plan(plan, result)
+            if rows is None:
+                continue
+            index = ((0 if format_number == 0 else
+                      cumulative[format_number - 1]) +
+                     self._rank_rows(colnames, [rows[pos]
+                                                for pos in positions]))
+            # Make sure that post-processing didn't change it.
+            if self.unrank(index) == result:
+                return index
+        raise ValueError('{!r} is not a known output of the '
+                         'generator'.format(result))
+
+    def iter_outputs(self, start=0, stop=None, step=1, seed=None):
+        r"""Generate a slice of the output space.
+
+        This yields unrank(i) for every i in range(start, stop, step).
+        Different slices of the same output space never overlap, so
+        several processes or machines can each be given a slice (for
+        example, a range of indices, or every nth index from a different
+        start) and between them generate distinct combinations of
+        format and roots, with no coordination.
+
+        If a seed is given, the output space is first shuffled by a
+        pseudo-random permutation that depends only on the seed, so
+        that each slice is a random selection from the whole space
+        rather than a run of similar outputs. Slices taken with the same
+        seed still never overlap.
+
+        For example, with two roots that can't both be used in one
+        string, because they share a row:
+            >>> import os.path, tempfile
+            >>> data_dir = tempfile.TemporaryDirectory()
+            >>> def write(filename, text):
+            ...     with open(os.path.join(data_dir.name, filename), 'w',
+            ...               encoding='utf-8') as file:
+            ...         file.write(text)
+            >>> write('pets.csv', 'Noun,Adj\ncat,red\ndog,\n,blue\n')
+            >>> write('pets.rules', '<RESULT> = [Adj] " " [Noun] | '
+            ...                     '[Noun] ?"s"\n')
+            >>> with Rulegen('pets', data_dir.name) as pets:
+            ...     size = pets.output_space_size()
+            ...     outputs = [pets.unrank(i) for i in range(size)]
+            ...     ranks = [pets.rank(output) for output in outputs]
+            ...     shards = [list(pets.iter_outputs(shard, step=3, seed=1))
+            ...               for shard in range(3)]
+            >>> data_dir.cleanup()
+            >>> sorted(outputs)
+            ['blue cat', 'blue dog', 'cat', 'cats', 'dog', 'dogs', 'red dog']
+            >>> ranks == list(range(size))
+            True
+            >>> sorted(sum(shards, [])) == sorted(outputs)
+            True
+
+        Keyword arguments:
+            start, stop, step -- As for range(). The default stop is
+                the result of output_space_size().
+            seed -- The seed for the shuffle, as a string or integer.
+                The default is None, meaning no shuffle.
+
+        Yields:
+            Strings.
+
+        """
+        size = self.output_space_size()
+        indices = range(size)[start:stop:step]
+        if seed is None:
+            positions = indices
+        else:
+            permute = _index_permutation(size, seed)
+            positions = (permute(index) for index in indices)
+        for index in positions:
+            yield self.unrank(index)
+
+    def _output_space(self):
+        """List the output formats and count the outputs of each.
+
+        The list is built once and cached until the database is rebuilt.
+
+        Returns:
+            A 2-tuple. The first element is a list of 3-tuples, one per
+            output format, of the compiled plan, the positions in the
+            plan of its lookups (sorted by column name), and the column
+            names of those lookups (in the same order). The second
+            element is a list of the running total of the number of
+            outputs, up to and including each format.
+
+        """
+        space = self._space
+        if space is None:
+            with self._lock:
+                if self._space is None:
+                    self._space = self._list_output_space()
+                space = self._space
+        return space
+
+    def _list_output_space(self):
+        """Build the list returned by _output_space()."""
+        if self.direct_sampling:
+            plans = (self.plan(fmt) for fmt in all_terminals(self.rules))
+        else:
+            plans = (self.plan(fmt, result_id)
+                     for result_id, fmt in
+                     zip(*self.column_index(self.results_datacol,
+                                            self.results_table,
+                                            self.results_idcol)))
+
+        formats, cumulative = [], []
+        total = 0
+        for plan in plans:
+            # Many formats look up the same columns, just in a different
+            # order or with different literals, so put the lookups in a
+            # standard order and count each combination only once.
+            positions = sorted((pos for pos, (_, colname) in enumerate(plan)
+                                if colname is not None),
+                               key=lambda pos: plan[pos][1])
+            colnames = tuple(plan[pos][1] for pos in positions)
+            formats.append((plan, positions, colnames))
+            total += self._distinct_row_count(colnames)
+            cumulative.append(total)
+        return formats, cumulative
+
+    def _unrank_rows(self, colnames, index):
+        """Pick the rows for some lookups, by position among all choices.
+
+        The rows are chosen one lookup at a time. The choices for each
+        lookup are grouped by which of the later lookups' columns the
+        row also has a value in, because every row in a group leaves
+        the same number of ways to fill in the rest.
+
+        Keyword arguments:
+            colnames -- A tuple of column names, one per lookup.
+            index -- An integer from 0 up to (but not including) the
+                result of _distinct_row_count(colnames).
+
+        Returns:
+            A list of row identifiers, one per lookup.
+
+        """
+        chosen, signatures = [], []
+        for start in range(len(colnames)):
+            classes, completions, cumulative = self._choices_of(
+                colnames[start:],
+                [signature >> start for signature in signatures])
+            n = bisect_right(cumulative, index)
+            if index < 0 or n == len(classes):
+                raise IndexError('output index out of range')
+            if n > 0:
+                index -= cumulative[n - 1]
+            mask, ids = classes[n]
+
+            # Find the chosen row among those in its group not already used.
+            pos, index = divmod(index, completions[n])
+            for used_pos in sorted(bisect_left(ids, row_id)
+                                   for row_id, signature in zip(chosen,
+                                                                signatures)
+                                   if signature >> start == (mask << 1) | 1):
+                if used_pos > pos:
+                    break
+                pos += 1
+            chosen.append(ids[pos])
+            # Only the later lookups' columns matter from now on.
+            signatures.append(self._row_signature(ids[pos],
+                                                  colnames[start + 1:]) <<
+                              (start + 1))
+        return chosen
+
+    def _choices_of(self, colnames, excluded):
+        """Count the ways to fill some lookups, by the row of the first.
+
+        Keyword arguments:
+            colnames -- A tuple of column names, one per lookup.
+            excluded -- An iterable of the signatures (see
+                _row_signature()) of the rows already used.
+
+        Returns:
+            A 3-tuple. The first element is the list of groups of rows
+            for the first lookup, as from _row_classes_of(). The second
+            is a list of the number of ways to fill the other lookups
+            after using a row from each group, and the third is a list
+            of the running total of the number of ways to fill all of
+            the lookups, up to and including each group.
+
+        """
+        excluded = tuple(sorted(signature for signature in excluded
+                                if signature != 0))
+        key = (colnames, excluded)
+        choices = self._choices.get(key)
+        if choices is None:
+            classes = self._row_classes_of(colnames)
+            completions, cumulative = [], []
+            total = 0
+            for mask, ids in classes:
+                count = self._completion_count(
+                    colnames[1:],
+                    [signature >> 1 for signature in excluded] + [mask])
+                used = excluded.count((mask << 1) | 1)
+                completions.append(count)
+                total += (len(ids) - used) * count
+                cumulative.append(total)
+            choices = self._choices[key] = (classes, completions, cumulative)
+        return choices
+
+    def _rank_rows(self, colnames, rows):
+        """Find the position of a choice of rows among all choices.
+
+        This is the inverse of _unrank_rows().
+
+        Keyword arguments:
+            colnames -- A tuple of column names, one per lookup.
+            rows -- A sequence of distinct row identifiers, one per
+                lookup, each with a value in its lookup's column.
+
+        Returns:
+            An integer.
+
+        """
+        index = 0
+        signatures = []
+        for start, row_id in enumerate(rows):
+            classes, completions, cumulative = self._choices_of(
+                colnames[start:],
+                [signature >> start for signature in signatures])
+            mask = self._row_signature(row_id, colnames[start + 1:])
+            n = bisect_left(classes, (mask,))
+            ids = classes[n][1]
+
+            # Count the rows before it in its group that are still unused.
+            pos = bisect_left(ids, row_id) - sum(
+                1 for used_id, signature in zip(rows, signatures)
+                if signature >> start == (mask << 1) | 1 and used_id < row_id)
+            index += ((0 if n == 0 else cumulative[n - 1]) +
+                      pos * completions[n])
+            signatures.append(mask << (start + 1))
+        return index
+
+    def _match_plan(self, plan, text):
+        """Find the rows that fill in a plan to make some text.
+
+        Keyword arguments:
+            plan -- A compiled generation plan, as from plan().
+            text -- A string, as it would be before post-processing.
+
+        Returns:
+            A dictionary mapping the position of each lookup in the plan
+            to a row identifier, with no row used twice; or None, if
+            the plan can't make the text.
+
+        """
+        rows = {}
+
+        def match(pos, offset):
+            if pos == len(plan):
+                return offset == len(text)
+            literal, colname = plan[pos]
+            if colname is None:
+                return (text.startswith(literal, offset) and
+                        match(pos + 1, offset + len(literal)))
+
+            value_rows, longest = self._value_rows_of(colname)
+            for end in range(offset + 1,
+                             min(len(text), offset + longest) + 1):
+                for row_id in value_rows.get(text[offset:end], ()):
+                    if row_id in rows.values():
+                        continue
+                    rows[pos] = row_id
+                    if match(pos + 1, end):
+                        return True
+                    del rows[pos]
+            return False
+
+        return rows if match(0, 0) else None
+
+    def _value_rows_of(self, colname):
+        """Map the values of a column of "Roots" to their rows.
+
+        Returns:
+            A 2-tuple. The first element is a dictionary mapping each
+            value to a list of the identifiers of the rows that have
+            it, and the second is the length of the longest value.
+
+        """
+        value_rows = self._value_rows.get(colname)
+        if value_rows is None:
+            mapping = {}
+            for row_id, value in zip(*self.column_index(colname)):
+                mapping.setdefault(value, []).append(row_id)
+            value_rows = self._value_rows[colname] = (
+                mapping, max(map(len, mapping), default=0))
+        return value_rows
+
+    def _distinct_row_count(self, colnames):
+        """Count the ways to fill some lookups without repeating a row.
+
+        Keyword arguments:
+            colnames -- A sequence of column names, one per lookup.
+
+        Returns:
+            An integer.
+
+        """
+        return self._completion_count(tuple(colnames), ())
+
+    def _completion_count(self, colnames, excluded):
+        """Count the ways to fill some lookups with unused rows.
+
+        A row can hold values for more than one column, so the rows are
+        grouped by which of the lookups' columns they have values in,
+        and the lookups of each column are shared out among the groups
+        one group at a time, keeping count of how many of each column's
+        lookups are still to fill. When the lookups all use the same
+        column, this is just a falling factorial. Counts are cached.
+
+        Keyword arguments:
+            colnames -- A tuple of column names, one per lookup.
+            excluded -- An iterable of the signatures (see
+                _row_signature()) of the rows already used.
+
+        Returns:
+            An integer.
+
+        """
+        # Rows that have no values in these columns make no difference.
+        excluded = tuple(sorted(signature for signature in excluded
+                                if signature != 0))
+        key = (colnames, excluded)
+        count = self._completions.get(key)
+        if count is not None:
+            return count
+
+        distinct = tuple(sorted(set(colnames)))
+        firsts = [colnames.index(colname) for colname in distinct]
+        needed = [colnames.count(colname) for colname in distinct]
+        class_sizes = dict(self._column_classes(distinct))
+        for signature in excluded:
+            mask = sum(1 << n for n, first in enumerate(firsts)
+                       if signature >> first & 1)
+            class_sizes[mask] -= 1
+
+        if len(distinct) == 0:
+            count = 1
+        elif len(distinct) == 1:
+            count = _falling_factorial(class_sizes.get(1, 0), needed[0])
+        else:
+            count = _injection_count(needed, class_sizes)
+        self._completions[key] = count
+        return count
+
+    def _column_classes(self, colnames):
+        """Count the rows with values in each combination of columns.
+
+        Keyword arguments:
+            colnames -- A tuple of distinct column names.
+
+        Returns:
+            A dictionary mapping a bit mask of columns (bit n for the nth
+            column) to the number of rows that have values in exactly
+            those columns. Rows with none of them are left out.
+
+        """
+        classes = self._column_class_counts.get(colnames)
+        if classes is None:
+            classes = {}
+            for row_id in frozenset().union(*(self._id_set(colname)
+                                              for colname in colnames)):
+                mask = self._row_signature(row_id, colnames)
+                classes[mask] = classes.get(mask, 0) + 1
+            self._column_class_counts[colnames] = classes
+        return classes
+
+    def _id_set(self, colname):
+        """Get the set of rows with a value in a column of "Roots"."""
+        ids = self._id_sets.get(colname)
+        if ids is None:
+            ids = self._id_sets[colname] = frozenset(
+                self.column_index(colname)[0])
+        return ids
+
+    def _row_signature(self, row_id, colnames):
+        """Get a bit mask of which of some columns a row has values in."""
+        return sum(1 << n for n, colname in enumerate(colnames)
+                   if row_id in self._id_set(colname))
+
+    def _row_classes_of(self, colnames):
+        """Group the rows of a column by which later columns they share.
+
+        Keyword arguments:
+            colnames -- A tuple of column names. The rows with values
+                in the first column are grouped, by which of the others
+                they also have values in.
+
+        Returns:
+            A list of 2-tuples, in a fixed order. The first element of
+            each is the signature (see _row_signature()) of the group's
+            rows in the other columns, and the second is an array of
+            their row identifiers, in ascending order.
+
+        """
+        classes = self._row_classes.get(colnames)
+        if classes is None:
+            grouped = {}
+            for row_id in self.column_index(colnames[0])[0]:
+                grouped.setdefault(self._row_signature(row_id, colnames[1:]),
+                                   array('q')).append(row_id)
+            classes = self._row_classes[colnames] = sorted(grouped.items())
+        return classes
+
+    def _fill_plan(self, plan, lookup):
+        """Fill in a generation plan with random data.
+
+        Keyword arguments:
+            plan -- A compiled generation plan, as from plan().
+            lookup -- A callable that takes a column name and a set of
+                row identifiers (as the seen_ids keyword argument), and
+                returns a random value from that column, not from any of
+                those rows, adding the row it used to the set.
+
+        Returns:
+            A string.
+
+        """
+        # The data rows seen so far belong to this string alone.
+        seen_ids = set()
 
         # This is a list of 2-tuples. The first element of each is the text to
         # add to the string; the second is None when the text came from a
         # string literal, or the name of the column when it came from a
         # database lookup.
-        result = []
-
-        # Start saving seen data rows.
-        self._seen_ids = set()
-
-        # Split the format into a sequence of database lookups and string
-        # literals.
-        for token in parse_terminals(fmt):
-            # Push string literals straight to output, but grab a random element
-            # from the database for each database lookup.
-            if isinstance(token, Literal):
-                if token.content != '':
-                    result.append((token.content, None))
-            else:
-                assert isinstance(token, DBLookup)
-                result.append((self.get_data(token.content), token.content))
+        result = [(text, None) if colname is None else
+                  (lookup(colname, seen_ids=seen_ids), colname)
+                  for text, colname in plan]
 
         # Apply any post-processing.
+        start = perf_counter() if self.metrics.enabled else None
         self.postprocess(result)
+        if start is not None:
+            self.metrics.record('postprocess', perf_counter() - start)
 
         return ''.join(text for text, _ in result)
 
     def postprocess(self, result):
         """Apply generator-specific processing to generated output.
 
+        The default is to apply each of the generator's postprocessors
+        in turn. Overriding this method in a subclass also works, but
+        then batches can't be processed as a whole.
+
         Keyword arguments:
             result -- A list (or other mutable sequence) of 2-tuples.
                 Each tuple contains a string and a column name (or None
@@ -354,36 +2059,616 @@ class Rulegen:
             None (the result argument is modified in-place).
 
         """
+        for stage in self.postprocessors:
+            stage.process(result)
+
+
+class Session:
+    r"""A run of generations that doesn't reuse roots.
+
+    Each column of the "Roots" table is a pool, from which values are
+    drawn without replacement across every string that the session
+    generates, until the pool runs dry. (The same row may still be used
+    once for each of its columns, though never twice in one string.)
+    Output formats can be pooled the same way.
+
+    Each pool keeps a shuffled order of its column's rows, and a cursor
+    into it, and the order is only shuffled as far as the cursor has
+    got, so each draw takes the same time however much of the pool has
+    been used.
+
+    The policy for a dry pool only applies once every row in it has
+    been used. If the rows that are left have all been used already in
+    the string being generated, one of the other rows is reused for that
+    draw, and the rows left stay in the pool:
+        >>> import os.path, tempfile
+        >>> data_dir = tempfile.TemporaryDirectory()
+        >>> def write(filename, text):
+        ...     with open(os.path.join(data_dir.name, filename), 'w',
+        ...               encoding='utf-8') as file:
+        ...         file.write(text)
+        >>> write('pairs.csv', 'A,B\na1,b1\na2,b2\na3,b3\n')
+        >>> write('pairs.rules', '<RESULT> = [A] " " [B]\n')
+        >>> left = set()
+        >>> with Rulegen('pairs', data_dir.name) as pairs:
+        ...     for _ in range(300):
+        ...         session = Session(pairs, on_exhausted='raise')
+        ...         outputs = session.generate_many(3)
+        ...         left.add((session.remaining('A'),
+        ...                   session.remaining('B')))
+        >>> data_dir.cleanup()
+        >>> sorted(left)
+        [(0, 0), (0, 1)]
+
+    A session belongs to the thread that uses it, and is tied to the
+    generator's database as it was when the session started. Rebuilding
+    the database ends the session: after that, drawing from any pool
+    that was already in use raises a RuntimeError.
+
+    Attributes:
+        generator -- The Rulegen instance to generate with.
+        formats -- True if output formats are pooled too. This is not
+            possible if the generator's direct_sampling attribute is
+            true.
+        on_exhausted -- What to do when a pool runs dry: "reshuffle" to
+            start using its values over again, in a new order; "raise"
+            to raise a LookupError; or "fallback" to go on drawing from
+            that column (or the formats) with replacement.
+
+    """
+    policies = ('reshuffle', 'raise', 'fallback')
+
+    def __init__(self, generator, formats=False, on_exhausted='reshuffle'):
+        """Start the session, with every pool full.
+
+        Keyword arguments:
+            generator, formats, on_exhausted -- As the instance
+                attributes. The defaults are False and "reshuffle".
+
+        Raises:
+            ValueError -- If the on_exhausted policy is unknown, or the
+                formats cannot be pooled.
+
+        """
+        if on_exhausted not in self.policies:
+            raise ValueError('unknown policy: {!r}'.format(on_exhausted))
+        if formats and generator.direct_sampling:
+            raise ValueError('formats sampled from the rules cannot be '
+                             'pooled')
+        self.generator = generator
+        self.formats = formats
+        self.on_exhausted = on_exhausted
+        self._pools = {}
+
+    def generate(self):
+        """Generate a random string from the pools.
+
+        Returns:
+            A string.
+
+        Raises:
+            LookupError -- If a pool runs dry and the policy is "raise".
+                Any values already drawn for the string are used up.
+            RuntimeError -- If the database has been rebuilt since the
+                session started.
+
+        """
+        generator = self.generator
+        if self.formats:
+            format_ids, formats = generator.column_index(
+                generator.results_datacol, generator.results_table,
+                generator.results_idcol)
+            pos = self._draw(None, format_ids, None)
+            plan = generator.plan(formats[pos], format_ids[pos])
+        elif generator.direct_sampling:
+            plan = generator.plan(generator.sampler.sample())
+        else:
+            format_ids, formats = generator.column_index(
+                generator.results_datacol, generator.results_table,
+                generator.results_idcol)
+            pos = generator._random_position(format_ids)
+            plan = generator.plan(formats[pos], format_ids[pos])
+        return generator._fill_plan(plan, self._lookup)
+
+    def generate_many(self, n):
+        """Generate a number of random strings from the pools."""
+        return [self.generate() for _ in range(n)]
+
+    def remaining(self, colname=None):
+        """Count the values left in a pool.
+
+        Keyword arguments:
+            colname -- The name of a column of the "Roots" table. The
+                default is None, meaning the pool of output formats.
+
+        Returns:
+            An integer.
+
+        Raises:
+            RuntimeError -- As for generate().
+
+        """
+        generator = self.generator
+        if colname is None:
+            ids, _ = generator.column_index(generator.results_datacol,
+                                            generator.results_table,
+                                            generator.results_idcol)
+        else:
+            ids, _ = generator.column_index(colname)
+        return len(ids) - self._pool(colname, ids).used
+
+    def _lookup(self, colname, seen_ids):
+        """Draw a value from a column's pool, for _fill_plan()."""
+        ids, values = self.generator.column_index(colname)
+        pos = self._draw(colname, ids, seen_ids)
+        seen_ids.add(ids[pos])
+        return values[pos]
+
+    def _draw(self, colname, ids, seen_ids):
+        """Draw a position from a pool, applying the policy if it's dry.
+
+        Keyword arguments:
+            colname -- The name of the column, or None for the formats.
+            ids -- An array of the row identifiers in the column.
+            seen_ids -- A set of row identifiers to avoid, or None.
+
+        Returns:
+            An integer index into the ids array.
+
+        """
+        pool = self._pool(colname, ids)
+        pos = pool.draw(seen_ids)
+        if pos is not None:
+            return pos
+        if pool.used < len(ids):
+            # The pool isn't dry; it's just that every row left in it is
+            # already in this string. Reuse a row for this draw only.
+            return self.generator._random_position(ids, seen_ids)
+
+        described = ('output formats' if colname is None else
+                     'values in column {!r}'.format(colname))
+        if self.on_exhausted == 'raise':
+            raise LookupError('no unused {} left in the '
+                              'session'.format(described))
+        elif self.on_exhausted == 'fallback':
+            return self.generator._random_position(ids, seen_ids)
+        else:
+            if self.generator.metrics.enabled:
+                self.generator.metrics.count('pool_reshuffles')
+            pool.reset()
+            pos = pool.draw(seen_ids)
+            if pos is None:
+                raise LookupError('no unused {} to choose '
+                                  'from'.format(described))
+            return pos
+
+    def _pool(self, colname, ids):
+        """Get the pool for a column, starting it if need be.
+
+        Keyword arguments:
+            colname -- The name of the column, or None for the formats.
+            ids -- The array of row identifiers in the column, as the
+                generator has it now.
+
+        Returns:
+            A _Pool instance.
+
+        Raises:
+            RuntimeError -- If the pool was started on a different
+                array, because the database has been rebuilt since.
+
+        """
+        pool = self._pools.get(colname)
+        if pool is None:
+            pool = self._pools[colname] = _Pool(ids)
+        elif pool.ids is not ids:
+            raise RuntimeError('the database has been rebuilt, which ends '
+                               'the session')
+        return pool
+
+
+class _ThreadOwner:
+    """A marker kept in a thread's local data, to see when it ends."""
+    __slots__ = ('__weakref__',)
+
+
+class _Pool:
+    """A column's rows, drawn in random order without replacement.
+
+    The draw order is shuffled lazily, one step of a Fisher–Yates
+    shuffle per draw.
+
+    Attributes:
+        ids -- The array of row identifiers in the column, as from
+            Rulegen.column_index().
+        used -- The number of rows drawn so far.
+
+    """
+    def __init__(self, ids):
+        self.ids = ids
+        self._order = array('q', range(len(ids)))
+        self.used = 0
+
+    def draw(self, seen_ids=None):
+        """Draw an unused row, not one of those seen.
+
+        Keyword arguments:
+            seen_ids -- A set of row identifiers to avoid, or None.
+
+        Returns:
+            An integer index into the ids array, or None if every unused
+            row has been seen.
+
+        """
+        ids, order, start = self.ids, self._order, self.used
+        if start >= len(order):
+            return None
+        pick = random.randrange(start, len(order))
+        if seen_ids is not None and ids[order[pick]] in seen_ids:
+            # As in Rulegen._random_position(), trying again is almost
+            # always enough, but the last few rows may all have been seen.
+            for _ in range(len(seen_ids)):
+                pick = random.randrange(start, len(order))
+                if ids[order[pick]] not in seen_ids:
+                    break
+            else:
+                unseen = [pick for pick in range(start, len(order))
+                          if ids[order[pick]] not in seen_ids]
+                if len(unseen) == 0:
+                    return None
+                pick = random.choice(unseen)
+        order[start], order[pick] = order[pick], order[start]
+        self.used += 1
+        return order[start]
+
+    def reset(self):
+        """Put every row back in the pool."""
+        self.used = 0
+
+
+def _file_hash(filename):
+    """Get the SHA-256 hash of a file's contents, as a hex string."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _index_permutation(size, seed, rounds=4):
+    """Make a pseudo-random permutation of range(size).
+
+    This is a small Feistel network, keyed by the seed, over the
+    smallest even number of bits that can hold every index. Indices
+    that it maps out of range are fed back in until they land in range
+    ("cycle walking"), which keeps it a permutation of range(size).
+
+    Keyword arguments:
+        size -- The number of indices to permute.
+        seed -- A string or integer.
+        rounds -- The number of Feistel rounds. The default is 4.
+
+    Returns:
+        A function that maps each index in range(size) to a different
+        index in range(size).
+
+    """
+    half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+    half_bytes = (half_bits + 7) // 8
+    mask = (1 << half_bits) - 1
+    key = hashlib.blake2b(str(seed).encode('utf-8')).digest()
+
+    def round_function(round_number, half):
+        digest = hashlib.blake2b(bytes([round_number]) +
+                                 half.to_bytes(half_bytes, 'little'),
+                                 key=key, digest_size=half_bytes).digest()
+        return int.from_bytes(digest, 'little') & mask
+
+    def permute(index):
+        if not 0 <= index < size:
+            raise IndexError('index out of range')
+        while True:
+            left, right = index >> half_bits, index & mask
+            for round_number in range(rounds):
+                left, right = right, left ^ round_function(round_number,
+                                                           right)
+            index = (left << half_bits) | right
+            if index < size:
+                return index
+
+    return permute
+
+
+def _falling_factorial(n, k):
+    """Count the ways to choose k of n things in order."""
+    if not 0 <= k <= n:
+        return 0
+    return factorial(n) // factorial(n - k)
+
+
+def _injection_count(needed, class_sizes):
+    """Count the ways to fill lookups from groups of rows, without reuse.
+
+    Keyword arguments:
+        needed -- A list of the number of lookups of each column.
+        class_sizes -- A dictionary mapping a bit mask of columns (bit
+            n for the nth column) to the number of rows that have values
+            in exactly those columns.
+
+    Returns:
+        An integer.
+
+    """
+    # Each state is the number of lookups of each column still to fill,
+    # mapped to the number of ways of choosing sets of rows to get there.
+    # Lookups of the same column are told apart at the end.
+    states = {tuple(needed): 1}
+    for mask, size in class_sizes.items():
+        columns = [n for n in range(len(needed)) if mask >> n & 1]
+        if size <= 0 or len(columns) == 0:
+            continue
+        new_states = {}
+        for state, ways in states.items():
+            for new_state, choices in _allocations(state, columns, size):
+                new_states[new_state] = (new_states.get(new_state, 0) +
+                                         ways * choices)
+        states = new_states
+
+    count = states.get((0,) * len(needed), 0)
+    for number in needed:
+        count *= factorial(number)
+    return count
+
+
+def _allocations(state, columns, size):
+    """Share out some rows of one group among the lookups they can fill.
+
+    Keyword arguments:
+        state -- A tuple of the number of lookups of each column still
+            to fill.
+        columns -- A list of the positions in state of the columns that
+            the group's rows have values in.
+        size -- The number of rows in the group.
+
+    Yields:
+        2-tuples of the state left after taking some of the rows, and
+        the number of ways to choose which rows go to which column.
+
+    """
+    if len(columns) == 0:
+        yield state, 1
         return
+    column, rest = columns[0], columns[1:]
+    for taken in range(min(state[column], size) + 1):
+        left = state[:column] + (state[column] - taken,) + state[column + 1:]
+        choices = comb(size, taken)
+        for new_state, more in _allocations(left, rest, size - taken):
+            yield new_state, choices * more
+
+
+# Registry of named generators, as served by the rulegenserver module.
+generators = {}
+
+
+def register(generator, name=None):
+    """Register a generator by name.
+
+    Keyword arguments:
+        generator -- A Rulegen instance.
+        name -- The name to register it under. The default is the
+            generator's data_prefix attribute.
+
+    Returns:
+        The generator.
+
+    """
+    generators[generator.data_prefix if name is None else name] = generator
+    return generator
 
 
 # Included generators.
-academia = Rulegen('academia', 'Academia')
-def _academia_postprocess(self, result):
-    """Delete doubled letters and drop O suffixes where necessary."""
-    if not os.path.isfile(self.dbfile):
-        self.build_db()
-
-    previous_end = None
-    for n, (text, colname) in enumerate(result):
-        changed = False
-        # Does this string duplicate the last letter of the previous?
-        if text[0] == previous_end:
-            changed = True
-            text = text[1:]
-
-        # Does the next string make this one drop an O?
-        if text[-1] == 'o' and n + 1 < len(result):
-            next_text, _ = result[n + 1]
-            if next_text[0] in 'aeiou':
-                changed = True
-                text = text[:-1]
-
-        # Were any changes made?
-        if changed:
-            result[n] = (text, colname)
-        previous_end = text[-1]
-academia.postprocess = types.MethodType(_academia_postprocess, academia)
-
-
-technobabble = Rulegen('technobabble', 'Technobabble')
+academia = register(Rulegen('academia', 'Academia',
+                            postprocessors=[Elision()]))
+
+
+technobabble = register(Rulegen('technobabble', 'Technobabble'))
+
+
+# Command-line interface.
+_cli_generators = {}
+
+
+def _cli_generator(data_prefix, data_dir, direct_sampling):
+    """Make a generator for the command-line interface.
+
+    If a generator is registered under the data prefix, the new one
+    gets its postprocessors, so that (for instance) Academia's output
+    is still elided.
+
+    Keyword arguments:
+        data_prefix, data_dir, direct_sampling -- As for Rulegen.
+
+    Returns:
+        A Rulegen instance.
+
+    """
+    registered = generators.get(data_prefix)
+    return Rulegen(data_prefix, data_dir, direct_sampling=direct_sampling,
+                   postprocessors=(() if registered is None else
+                                   registered.postprocessors))
+
+
+def _generate_chunk(args):
+    """Generate one chunk of output for the command-line interface.
+
+    This runs in worker processes when more than one job is requested,
+    so it takes a single tuple of arguments, and keeps one generator
+    per process for reuse.
+
+    Keyword arguments:
+        args -- A tuple of the data_prefix, data_dir and direct_sampling
+            arguments for the generator, a seed (or None), and the
+            number of strings to generate.
+
+    Returns:
+        A list of strings.
+
+    """
+    data_prefix, data_dir, direct_sampling, seed, n = args
+    key = (data_prefix, data_dir, direct_sampling)
+    if key not in _cli_generators:
+        _cli_generators[key] = _cli_generator(data_prefix, data_dir,
+                                              direct_sampling)
+    if seed is not None:
+        random.seed(seed)
+    return _cli_generators[key].generate_many(n)
+
+
+def main(argv=None):
+    """Generate strings from the command line.
+
+    Run "python -m rulegen --help" for usage.
+
+    Keyword arguments:
+        argv -- A list of command-line arguments, not including the
+            program name. The default is sys.argv[1:].
+
+    Returns:
+        An exit status.
+
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m rulegen',
+        description='Generate random strings with a rules-based generator.')
+    parser.add_argument('data_prefix',
+                        help='filename (minus the extension) of the '
+                        'generator\'s data files')
+    parser.add_argument('data_dir', nargs='?',
+                        help='directory where the data files are found '
+                        '(default: the current directory)')
+    parser.add_argument('-n', '--count', type=int, default=1,
+                        help='number of strings to generate (default: 1)')
+    parser.add_argument('-s', '--seed',
+                        help='seed for the random number generator, for '
+                        'output that is repeatable (given the same '
+                        '--chunk-size, but any number of --jobs)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes (default: 1)')
+    parser.add_argument('-u', '--unique', action='store_true',
+                        help='do not output any string more than once '
+                        '(this is done in a single process, whatever '
+                        '--jobs says)')
+    parser.add_argument('-0', '--null', action='store_true',
+                        help='end each string with a NUL character instead '
+                        'of a newline')
+    parser.add_argument('--direct', action='store_true',
+                        help='sample output formats directly from the rules '
+                        'file, instead of from a table of every format')
+    parser.add_argument('--shard', metavar='I/N',
+                        help='output only every Nth combination of format '
+                        'and roots, starting from the Ith (counting from '
+                        '0), so that N runs with the same --seed produce '
+                        'no combination twice')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='number of strings to generate and write at a '
+                        'time (default: 10000)')
+    args = parser.parse_args(argv)
+    if args.count < 0 or args.jobs < 1 or args.chunk_size < 1:
+        parser.error('--count must not be negative, and --jobs and '
+                     '--chunk-size must be positive')
+    if args.shard is not None:
+        try:
+            shard, shards = (int(part) for part in args.shard.split('/'))
+        except ValueError:
+            parser.error('--shard must be two integers, as in 0/4')
+        if not 0 <= shard < shards:
+            parser.error('--shard must be from 0/N to (N-1)/N')
+        if args.unique:
+            parser.error('--shard and --unique cannot be used together')
+
+    # Make sure the database is ready before any workers go looking for it.
+    generator = _cli_generator(args.data_prefix, args.data_dir, args.direct)
+    generator.connect()
+    if args.unique and args.count > generator.output_space_size():
+        parser.error('cannot generate {} unique strings; the generator only '
+                     'has {} possible outputs'.format(
+                         args.count, generator.output_space_size()))
+    if not args.unique and args.shard is None:
+        generator.close()
+
+    # Each chunk is seeded from the seed and its own position, so output
+    # doesn't depend on how many jobs there are. The last chunk is only as
+    # big as it needs to be.
+    def chunks():
+        for chunk_number, start in enumerate(range(0, args.count,
+                                                   args.chunk_size)):
+            seed = (None if args.seed is None else
+                    '{}:{}'.format(args.seed, chunk_number))
+            yield (args.data_prefix, args.data_dir, args.direct, seed,
+                   min(args.chunk_size, args.count - start))
+
+    pool = None
+    if args.unique or args.shard is not None:
+        if args.unique:
+            # This needs the whole output space in one place, so it's done
+            # in a single process.
+            outputs = generator._iter_unique(args.seed)
+        else:
+            # The shard is a fixed slice of the output space, so there's
+            # nothing to gain from more processes.
+            outputs = generator.iter_outputs(shard, None, shards,
+                                             seed=args.seed)
+        results = iter(lambda: list(islice(outputs, min(args.chunk_size,
+                                                        remaining))), [])
+    elif args.jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(args.jobs)
+
+        # Keep a couple of chunks per worker in hand, but no more, so that
+        # memory use doesn't grow with the count.
+        def pooled_results():
+            pending = deque()
+            for chunk_args in chunks():
+                pending.append(pool.apply_async(_generate_chunk,
+                                                (chunk_args,)))
+                if len(pending) >= 2 * args.jobs:
+                    yield pending.popleft().get()
+            while len(pending) > 0:
+                yield pending.popleft().get()
+        results = pooled_results()
+    else:
+        results = map(_generate_chunk, chunks())
+
+    terminator = '\0' if args.null else '\n'
+    out = sys.stdout.buffer
+    remaining = args.count
+    try:
+        while remaining > 0:
+            # Only a shard, or the distinct strings, can run out before the
+            # count is reached.
+            chunk = next(results, [])
+            if len(chunk) == 0:
+                break
+            remaining -= len(chunk)
+            out.write(''.join(text + terminator
+                              for text in chunk).encode('utf-8'))
+        out.flush()
+        if args.unique and remaining > 0:
+            print('{}: only {} distinct strings could be '
+                  'generated'.format(parser.prog, args.count - remaining),
+                  file=sys.stderr)
+            return 1
+    except BrokenPipeError:
+        # Whoever was reading the output has stopped. That's fine.
+        sys.stderr.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        generator.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
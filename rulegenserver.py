@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+"""Serve rules-based random generators over a local socket.
+
+A long-running server keeps its generators loaded, with their rules
+parsed, databases connected and indexes built, so that short-lived
+clients don't have to pay those costs themselves.
+
+The protocol is line-based JSON. Each request is one JSON object on a
+line of its own, and each gets exactly one JSON object line in reply.
+Requests on one connection may be pipelined (sent without waiting for
+earlier replies), and replies come back in the order the requests were
+sent. A request has these members:
+    method -- Either "generate" or "generate_many".
+    generator -- The name of a registered generator.
+    n -- For "generate_many" only, the number of strings wanted.
+    id -- Optional. Any JSON value, which is copied into the reply.
+A successful reply has a "result" member: a string for "generate", or
+a list of strings for "generate_many". A failed request gets a reply
+with an "error" member instead, containing a message.
+
+"""
+# Copyright © 2015 Timothy Pederick.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import socket
+
+# Local imports.
+import rulegen
+
+# Protocol limits.
+MAX_LINE = 1 << 16
+MAX_BATCH = 100000
+MAX_PIPELINED = 64
+
+
+class GenerationServer:
+    """A server for generation requests.
+
+    All generation happens on a single worker thread, so that requests
+    are carried out one at a time, in order, and the event loop is
+    never blocked.
+
+    Attributes:
+        generators -- A mapping of names to Rulegen instances.
+        max_batch -- The largest number of strings that one
+            "generate_many" request may ask for.
+
+    """
+    def __init__(self, generators=None, max_batch=MAX_BATCH):
+        """Initialise the server.
+
+        Keyword arguments:
+            generators -- As the instance attribute. The default is the
+                rulegen module's registry of generators.
+            max_batch -- As the instance attribute.
+
+        """
+        self.generators = (rulegen.generators if generators is None else
+                           generators)
+        self.max_batch = max_batch
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._server = None
+
+    def _preload(self):
+        """Get every generator ready to generate."""
+        for generator in self.generators.values():
+            generator.generate_many(1)
+
+    def _call(self, request):
+        """Carry out a request on the worker thread.
+
+        Keyword arguments:
+            request -- A decoded request.
+
+        Returns:
+            The result to send back.
+
+        """
+        try:
+            generator = self.generators[request['generator']]
+        except KeyError:
+            raise ValueError('no such generator: '
+                             '{!r}'.format(request.get('generator')))
+
+        method = request.get('method')
+        if method == 'generate':
+            return generator.generate_many(1)[0]
+        elif method == 'generate_many':
+            n = request.get('n')
+            # JSON true and false come through as bools, which are ints too.
+            if (isinstance(n, bool) or not isinstance(n, int) or
+                    not 0 <= n <= self.max_batch):
+                raise ValueError('n must be an integer from 0 to '
+                                 '{}'.format(self.max_batch))
+            return generator.generate_many(n)
+        else:
+            raise ValueError('no such method: {!r}'.format(method))
+
+    async def _respond(self, line):
+        """Work out the reply to one line of input.
+
+        Keyword arguments:
+            line -- A line of input, as bytes.
+
+        Returns:
+            A dictionary to send back as JSON.
+
+        """
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('request must be a JSON object')
+        except ValueError as err:
+            return {'error': 'bad request: {}'.format(err)}
+
+        reply = {} if 'id' not in request else {'id': request['id']}
+        try:
+            reply['result'] = await asyncio.get_running_loop(
+                ).run_in_executor(self._executor, self._call, request)
+        except Exception as err:
+            reply['error'] = str(err)
+        return reply
+
+    async def _handle(self, reader, writer):
+        """Serve one client connection."""
+        # Replies are queued in request order, as soon as each request is
+        # read; the queue is bounded, so a client that pipelines too far
+        # ahead just has to wait.
+        replies = asyncio.Queue(MAX_PIPELINED)
+
+        async def send_replies():
+            while True:
+                reply = await replies.get()
+                if reply is None:
+                    break
+                writer.write(json.dumps(await reply).encode('utf-8') + b'\n')
+                await writer.drain()
+
+        sender = asyncio.ensure_future(send_replies())
+        try:
+            while not sender.done():
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # The line is too long to be a sensible request.
+                    too_long = asyncio.get_running_loop().create_future()
+                    too_long.set_result({'error': 'bad request: line too '
+                                                  'long'})
+                    await replies.put(too_long)
+                    break
+                if len(line) == 0:
+                    break
+                if line.strip():
+                    await replies.put(asyncio.ensure_future(
+                        self._respond(line)))
+            if not sender.done():
+                await replies.put(None)
+            await sender
+        except (ConnectionError, asyncio.CancelledError):
+            sender.cancel()
+        finally:
+            writer.close()
+
+    async def start(self, path=None, host='127.0.0.1', port=0):
+        """Preload the generators and start serving.
+
+        Keyword arguments:
+            path -- The filename of a Unix domain socket to listen on.
+                If omitted, a TCP socket on host and port is used.
+            host -- The host to listen on. The default is localhost.
+            port -- The TCP port to listen on. The default is 0, meaning
+                any free port.
+
+        Returns:
+            The socket address actually being listened on.
+
+        """
+        await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                         self._preload)
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path,
+                                                           limit=MAX_LINE)
+        else:
+            self._server = await asyncio.start_server(self._handle, host,
+                                                      port, limit=MAX_LINE)
+        return self._server.sockets[0].getsockname()
+
+    async def serve_forever(self):
+        """Serve requests until cancelled."""
+        await self._server.serve_forever()
+
+    async def close(self):
+        """Stop serving, and close the generators' connections."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        loop = asyncio.get_running_loop()
+        for generator in self.generators.values():
+            await loop.run_in_executor(self._executor, generator.close)
+        self._executor.shutdown()
+
+
+class Client:
+    """A simple blocking client for a generation server.
+
+    Use as a context manager, or call close() when finished.
+
+    """
+    def __init__(self, path=None, host='127.0.0.1', port=None):
+        """Connect to a generation server.
+
+        Keyword arguments:
+            path -- The filename of the server's Unix domain socket. If
+                omitted, a TCP connection to host and port is made.
+            host, port -- The TCP address of the server.
+
+        """
+        if path is not None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(path)
+        else:
+            self._sock = socket.create_connection((host, port))
+        self._file = self._sock.makefile('rwb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the connection."""
+        self._file.close()
+        self._sock.close()
+
+    def pipeline(self, requests):
+        """Send several requests at once, then collect the replies.
+
+        Keyword arguments:
+            requests -- A list of request dictionaries.
+
+        Returns:
+            A list of results, in the same order as the requests.
+
+        Raises:
+            RuntimeError -- If the server reported an error for any
+                request.
+
+        """
+        for request in requests:
+            self._file.write(json.dumps(request).encode('utf-8') + b'\n')
+        self._file.flush()
+
+        # Read every reply before raising for any error, so that the next
+        # call doesn't get this call's leftover replies.
+        replies = []
+        for _ in requests:
+            line = self._file.readline()
+            if len(line) == 0:
+                raise ConnectionError('server closed the connection')
+            replies.append(json.loads(line))
+        for reply in replies:
+            if 'error' in reply:
+                raise RuntimeError(reply['error'])
+        return [reply['result'] for reply in replies]
+
+    def generate(self, generator):
+        """Generate a string with a named generator on the server."""
+        return self.pipeline([{'method': 'generate',
+                               'generator': generator}])[0]
+
+    def generate_many(self, generator, n):
+        """Generate n strings with a named generator on the server."""
+        return self.pipeline([{'method': 'generate_many',
+                               'generator': generator, 'n': n}])[0]
+
+
+def main(argv=None):
+    """Run a generation server from the command line."""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Serve rules-based random generators.')
+    parser.add_argument('--unix', metavar='PATH',
+                        help='listen on a Unix domain socket at PATH')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='TCP host to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=0,
+                        help='TCP port to listen on (default: any free port)')
+    args = parser.parse_args(argv)
+
+    async def run():
+        server = GenerationServer()
+        address = await server.start(args.unix, args.host, args.port)
+        print('Serving on {}'.format(address), flush=True)
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -46,15 +46,32 @@ characters (\n), and the backslash itself.
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Standard library imports.
-from collections import defaultdict
-from copy import copy
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from functools import lru_cache, partial
+import hashlib
+import io
+from itertools import chain, product
+import json
+import random
+import re
+import sys
 
 # Local imports.
+from atomicfile import replacing
+from instrumentation import Stats
 from toposort import toposort, CyclicGraphError
 
 # Root of generation rules.
 INITIAL = 'RESULT'
 
+# Counters and timings for this module. Disabled until stats.enabled is set.
+stats = Stats()
+
+# Compiled-rules cache files.
+CACHE_SUFFIX = '.cache'
+CACHE_VERSION = 1
+
 # Parser states.
 (AWAITING_NONTERMINAL, AWAITING_EQUALS, AWAITING_START_OF_RULE,
  CONTINUING_RULE, JUST_HAD_OPTION, INSIDE_NONTERMINAL,
@@ -122,6 +139,10 @@ class Control(Token):
         return self.content
 
 
+TOKEN_TYPES = {cls.__name__: cls
+               for cls in (Nonterminal, Literal, DBLookup, Control)}
+
+
 # Syntax characters.
 NONTERMINAL_START, NONTERMINAL_END = '<>'
 LITERAL_START = LITERAL_END = '"'
@@ -157,8 +178,54 @@ class ParseError(RuleParserError):
         super().__init__(message)
 
 
+# Regular expressions for parsing whole rules at once. The content of a
+# token is any run of escaped characters (including newlines) or unescaped
+# characters other than its closing character.
+_NONTERMINAL = r'<((?:[^>\\]|\\.)*)>'
+_LITERAL = r'"((?:[^"\\]|\\.)*)"'
+_DBLOOKUP = r'\[((?:[^\]\\]|\\.)*)\]'
+_TOKEN = '|'.join((_NONTERMINAL, _LITERAL, _DBLOOKUP))
+_ITEM = r'(?:\?\s*)?(?:{})'.format(_TOKEN)
+_VALID_RULE = re.compile(r'\s*(?:#.*)?'
+                         r'|\s*{0}\s*=\s*{1}(?:\s*\|?\s*{1})*'
+                         r'(?:\s*\?\s*|\s*(?:#.*)?)'.format(_NONTERMINAL,
+                                                            _ITEM),
+                         re.DOTALL)
+_RULE_TOKEN = re.compile(_TOKEN + r'|([=|?])|(#)', re.DOTALL)
+_TOKEN_GROUPS = {1: Nonterminal, 2: Literal, 3: DBLookup}
+_CONTROL_GROUP, _COMMENT_GROUP = 4, 5
+_ESCAPE = re.compile(r'\\(.)', re.DOTALL)
+
+
 def parse_rule(rule):
-    """Parse a single rule."""
+    """Parse a single rule.
+
+    Valid rules are scanned with regular expressions. Anything else is
+    handed to a character-by-character parser, which finds the error.
+        >>> print(*parse_rule('<A> = ?"x" | [B]  # Comment'))
+        <A> = ? "x" | [B]
+
+    """
+    if _VALID_RULE.fullmatch(rule) is None:
+        return _parse_rule_by_char(rule)
+
+    tokens = []
+    for match in _RULE_TOKEN.finditer(rule):
+        group = match.lastindex
+        if group == _COMMENT_GROUP:
+            break
+        content = match.group(group)
+        if group == _CONTROL_GROUP:
+            tokens.append(Control(content))
+        else:
+            if ESCAPE_START in content:
+                content = _ESCAPE.sub(r'\1', content)
+            tokens.append(_TOKEN_GROUPS[group](content))
+    return tokens
+
+
+def _parse_rule_by_char(rule):
+    """Parse a single rule, one character at a time."""
     tokens = []
 
     state = AWAITING_NONTERMINAL
@@ -275,29 +342,95 @@ def parse_rules(rulefile):
     Keyword arguments:
         rulefile -- The filename of the file of rules.
 
+    """
+    with open(rulefile, encoding='utf-8') as rf, stats.timer('parse_rules'):
+        return _parse_lines(rf)
+
+
+def load_rules(rulefile, cachefile=None):
+    """Parse a file of rules, reusing a cached parse if possible.
+
+    The parsed and validated rules are stored as JSON in a cache file
+    next to the rules file, together with the SHA-256 hash of the rules
+    file's contents. As long as that hash still matches, the rules are
+    loaded from the cache without being parsed again. Otherwise, they
+    are parsed as by parse_rules() and the cache is rewritten (if the
+    cache file can be written at all).
+
+    Keyword arguments:
+        rulefile -- The filename of the file of rules.
+        cachefile -- The filename of the cache file. The default is the
+            rules filename with CACHE_SUFFIX appended.
+
+    """
+    if cachefile is None:
+        cachefile = rulefile + CACHE_SUFFIX
+    with open(rulefile, 'rb') as rf:
+        contents = rf.read()
+    digest = hashlib.sha256(contents).hexdigest()
+
+    try:
+        with open(cachefile, encoding='utf-8') as cf:
+            cache = json.load(cf)
+        if cache['version'] == CACHE_VERSION and cache['hash'] == digest:
+            if stats.enabled:
+                stats.count('rules_cache_hits')
+            return {name: [TOKEN_TYPES[token_type](content)
+                           for token_type, content in production]
+                    for name, production in cache['rules'].items()}
+    except (OSError, ValueError, KeyError, TypeError):
+        # No usable cache. Parse the rules after all.
+        pass
+
+    # Parse exactly the contents that were hashed, in case the file has
+    # changed since.
+    if stats.enabled:
+        stats.count('rules_cache_misses')
+    with stats.timer('parse_rules'):
+        rules = _parse_lines(io.TextIOWrapper(io.BytesIO(contents),
+                                              encoding='utf-8'))
+    cache = {'version': CACHE_VERSION, 'hash': digest,
+             'rules': {name: [(type(token).__name__, token.content)
+                              for token in production]
+                       for name, production in rules.items()}}
+    try:
+        with replacing(cachefile) as tempfile:
+            with open(tempfile, 'w', encoding='utf-8') as cf:
+                json.dump(cache, cf)
+    except OSError:
+        # The cache is only an optimisation, so never mind.
+        pass
+    return rules
+
+
+def _parse_lines(lines):
+    """Parse and validate lines of rules.
+
+    Keyword arguments:
+        lines -- An iterable of strings, each a line of a rules file.
+
     """
     # Read and parse the rules.
     rules = {}
-    with open(rulefile, encoding='utf-8') as rf:
-        for line in rf:
-            parsed_rule = parse_rule(line)
-            if len(parsed_rule) > 0:
-                # Unpack the nonterminal, the equals sign, and the rest of the
-                # rule (the actual production).
-                nonterminal, equals, *production = parsed_rule
-
-                if (not isinstance(nonterminal, Nonterminal) or
-                    not (isinstance(equals, Control) and
-                         equals.content == '=')):
-                    # Wait, what?
-                    raise RuleError('parsed rule is nonconformant')
-
-                if nonterminal.content in rules:
-                    raise RuleError('attempted redefinition of '
-                                    '{!r}'.format(nonterminal.content))
-                else:
-                    rules[nonterminal.content] = production
-            # Else there were no tokens (e.g. a blank line or comment).
+    for line in lines:
+        parsed_rule = parse_rule(line)
+        if len(parsed_rule) > 0:
+            # Unpack the nonterminal, the equals sign, and the rest of the
+            # rule (the actual production).
+            nonterminal, equals, *production = parsed_rule
+
+            if (not isinstance(nonterminal, Nonterminal) or
+                not (isinstance(equals, Control) and
+                     equals.content == '=')):
+                # Wait, what?
+                raise RuleError('parsed rule is nonconformant')
+
+            if nonterminal.content in rules:
+                raise RuleError('attempted redefinition of '
+                                '{!r}'.format(nonterminal.content))
+            else:
+                rules[nonterminal.content] = production
+        # Else there were no tokens (e.g. a blank line or comment).
 
     # Check that all nonterminals have definitions ending in terminals, and
     # that the initial nonterminal, <RESULT>, exists.
@@ -315,7 +448,10 @@ def parse_rules(rulefile):
 
         for token in production:
             if isinstance(token, Nonterminal):
-                unseen_nonterminals.add(token.content)
+                # Don't revisit nonterminals, or recursive rules would keep
+                # this loop going forever.
+                if token.content not in seen_nonterminals:
+                    unseen_nonterminals.add(token.content)
                 dependencies[next_nonterminal].append(token.content)
 
     # Are all nonterminal definitions reachable from <RESULT>?
@@ -332,66 +468,35 @@ def parse_rules(rulefile):
     try:
         toposort(dependencies, startnodes={INITIAL})
     except CyclicGraphError as cge:
-        raise RuleError('recursive rule definition exists') from cge
+        if cge.cycle is None:
+            raise RuleError('recursive rule definition exists') from cge
+        raise RuleError('recursive rule definition exists: '
+                        '{}'.format(' -> '.join(str(Nonterminal(name))
+                                                for name in cge.cycle))
+                        ) from cge
     return rules
 
 
-class Tree:
-    """A stupidly simple n-ary tree."""
-    def __init__(self, content, parent=None):
-        self.content = content
-        self.parent = parent
-        self.children = []
-
-    def expand(self, rules):
-        """Expand this (sub-)tree, if possible."""
-        expanded = False
-
-        if isinstance(self.content, Nonterminal):
-            # Expand nonterminals to their results.
-            expanded = True
-            self.children = [Tree(token, self)
-                                for token in rules[self.content.content]]
-        elif isinstance(self.content, Control):
-            # All control tokens cause expansion and require the position of
-            # this node within its parent's children.
-            expanded = True
-            node_pos = self.parent.children.index(self)
-
-            if self.content.content == OPTION:
-                # Expand options to two nodes, one with and one without the
-                # next sibling (the optional token).
-                optional_token = self.parent.children.pop(node_pos + 1)
-                first_child = (optional_token if isinstance(optional_token,
-                                                            Tree) else
-                               Tree(optional_token))
-                first_child.parent = self
-                self.children = [first_child, Tree(None, self)]
-            else:
-                assert self.content.content == SELECTION
-                # Expand selections to two nodes, one with all prior siblings
-                # and one with all following siblings.
-                prior = self.parent.children[:node_pos]
-                following = self.parent.children[node_pos + 1:]
-                left, right = Tree(True, self), Tree(False, self)
-                left.children, right.children = prior, following
-                # Reparent all those transplanted children.
-                for side in left, right:
-                    for child in side.children:
-                        child.parent = side
-                self.parent.children = [self]
-                self.children = [left, right]
-
-        return expanded
-
-
-def all_terminals(rules):
+def all_terminals(rules, unique=True, memory_limit=None):
     r"""Generate all possible terminal sequences from a parsed ruleset.
 
     Each result is a string containing only terminal tokens (string
     literals and database lookups). As database lookups are enclosed in
     square brackets, any square brackets that appear in string literals
     are escaped.
+
+    Weeding out repeated sequences means remembering every one so far,
+    which for a big enough ruleset takes more memory than is available.
+    Callers that can weed them out some other way (for instance, with a
+    unique index in a database) can pass unique=False to skip this.
+
+    Each nonterminal other than <RESULT> is expanded once, and its
+    sequences kept for reuse, as long as they fit within memory_limit.
+    Those that don't fit are expanded again every time they are used
+    instead, which is slower but takes no memory. Along with
+    unique=False, this bounds the memory used however many sequences
+    there are. (Sequences of a nonterminal that isn't kept can be
+    repeated, so they are only weeded out if unique is true.)
         >>> test_rules = {INITIAL: [Nonterminal('A'), Literal(' '),
         ...                         Nonterminal('B')],
         ...               'A': [Literal('Hello'), Control(SELECTION),
@@ -404,65 +509,611 @@ def all_terminals(rules):
         Hello world
         Goodbye \[cruel\] world
         Goodbye world
+        >>> (list(all_terminals(test_rules, memory_limit=0)) ==
+        ...  list(all_terminals(test_rules)))
+        True
+
+    Keyword arguments:
+        rules -- A parsed ruleset, as from parse_rules().
+        unique -- False if repeated sequences may be generated more than
+            once. The default is True.
+        memory_limit -- Roughly the most memory, in bytes, to spend on
+            keeping the sequences of nonterminals other than <RESULT>,
+            or None (the default) to keep them all.
 
     """
+    # Expand every nonterminal other than <RESULT> into its distinct
+    # terminal sequences, once each, starting from those that depend on no
+    # other nonterminals. Shared rules are thus only expanded once. Any that
+    # would go over the memory limit are left to be expanded as they're
+    # used, and stand in the expansions as a function to do that.
+    expansions = {}
+    budget = memory_limit
+    with stats.timer('expand_rules'):
+        alts = {name: alternatives(production)
+                for name, production in rules.items()}
+        for name in _bottom_up(alts):
+            if name == INITIAL:
+                continue
+            terminal_seqs = _unique(_expand(alts[name], expansions))
+            if budget is None:
+                expansions[name] = list(terminal_seqs)
+                continue
+            expansion, size = [], 0
+            for terminal_seq in terminal_seqs:
+                # Allow for the list and the set in _unique(), as well as
+                # the string.
+                size += sys.getsizeof(terminal_seq) + 40
+                if size > budget:
+                    if stats.enabled:
+                        stats.count('expansions_not_kept')
+                    expansions[name] = partial(_expand, alts[name],
+                                               expansions)
+                    break
+                expansion.append(terminal_seq)
+            else:
+                expansions[name] = expansion
+                budget -= size
+
     # Store terminal sequences in a set, so that duplicates (sequences which
     # can be arrived at through more than one production) are weeded out.
-    terminal_seqs = set()
-    ruletree = Tree(Nonterminal(INITIAL))
-
-    all_leaves_are_terminals = False
-
-    while not all_leaves_are_terminals:
-        # Assume we're going to break out on this iteration.
-        all_leaves_are_terminals = True
-
-        # Traverse the tree breadth-first, expanding each node as we go.
-        nodes = [ruletree]
-        while len(nodes) > 0:
-            next_node = nodes.pop(0)
-            # If it's not a leaf node, expand it.
-            if len(next_node.children) == 0:
-                all_leaves_are_terminals = (all_leaves_are_terminals and
-                                            not next_node.expand(rules))
-            # Traverse over its children.
-            nodes.extend(next_node.children)
-
-    # Traverse the tree depth-first, yielding terminal sequences this time.
-    stack = [([], [ruletree])]
-    while len(stack) > 0:
-        current, nodes = stack.pop()
-
-        while len(nodes) > 0:
-            next_node = nodes.pop()
-            # For terminals, add them to this sequence.
-            if isinstance(next_node.content, Terminal):
-                assert len(next_node.children) == 0
-                if next_node.content is not None:
-                    current.append(next_node.content.escape_brackets()
-                                   if isinstance(next_node.content,
-                                                 Literal) else
-                                   str(next_node.content))
-            # For control tokens, save the state with one alternative. Output
-            # a sequence with the other alternative. Then reload the state and
-            # use the first alternative.
-            elif isinstance(next_node.content, Control):
-                copy_of_current, copy_of_nodes = copy(current), copy(nodes)
-
-                option_a, option_b = next_node.children
-                nodes.append(option_a)
-                copy_of_nodes.append(option_b)
-
-                stack.append((copy_of_current, copy_of_nodes))
-            # For anything else, iterate over its children.
+    # The expansion of <RESULT> is the whole output, so don't keep it as a
+    # list; just stream it.
+    terminal_seqs = _expand(alts[INITIAL], expansions)
+    yield from _unique(terminal_seqs) if unique else terminal_seqs
+
+
+def _expand(alts, expansions):
+    """Generate the terminal sequences of a list of alternatives.
+
+    Sequences are generated in the same order as a depth-first walk of
+    the choices in the rules: earlier alternatives first, an optional
+    token before its absence, and later choices varying fastest.
+
+    Keyword arguments:
+        alts -- A list of alternatives, as from alternatives().
+        expansions -- A mapping of nonterminal names to lists of their
+            terminal sequences, for every nonterminal in alts. Instead
+            of a list, a nonterminal can have a function that generates
+            its sequences afresh each time it is called.
+
+    """
+    for alternative in alts:
+        choices = []
+        for optional, token in alternative:
+            options = (expansions[token.content]
+                       if isinstance(token, Nonterminal) else
+                       [terminal_text(token)])
+            if not callable(options):
+                choices.append(options + [''] if optional else options)
+            elif optional:
+                choices.append(partial(_with_empty, options))
             else:
-                nodes.extend(reversed(next_node.children))
-        terminal_seq = ''.join(current)
-        if terminal_seq not in terminal_seqs:
-            terminal_seqs.add(terminal_seq)
+                choices.append(options)
+        if any(callable(choice) for choice in choices):
+            yield from _lazy_product(choices)
+        else:
+            for parts in product(*choices):
+                yield ''.join(parts)
+
+
+def _with_empty(options):
+    """Generate the sequences of a nonterminal, then an empty one."""
+    return chain(options(), ('',))
+
+
+def _lazy_product(choices):
+    """Join every combination of choices, like product() in _expand().
+
+    Unlike product(), this doesn't read each choice into memory first.
+    Instead, choices that are functions are called to generate their
+    options again for each combination of the choices before them.
+
+    """
+    if len(choices) == 0:
+        yield ''
+        return
+    first, rest = choices[0], choices[1:]
+    for part in (first() if callable(first) else first):
+        for parts in _lazy_product(rest):
+            yield part + parts
+
+
+def _unique(terminal_seqs):
+    """Filter out repeats from an iterable of terminal sequences."""
+    seen = set()
+    for terminal_seq in terminal_seqs:
+        if terminal_seq not in seen:
+            seen.add(terminal_seq)
             yield terminal_seq
 
 
+def alternatives(production):
+    """Split a production into its alternatives.
+
+    Selection has the lowest precedence of any operator, so a production
+    is a list of alternatives separated by selection tokens. Each
+    alternative is a sequence of terminals and nonterminals, any of
+    which may be marked as optional.
+        >>> for alternative in alternatives([Control(OPTION),
+        ...                                  Nonterminal('A'), Literal('b'),
+        ...                                  Control(SELECTION),
+        ...                                  DBLookup('C')]):
+        ...     print(alternative)
+        [(True, Nonterminal('A')), (False, Literal('b'))]
+        [(False, DBLookup('C'))]
+
+    Keyword arguments:
+        production -- A list of tokens, as found in the values of a
+            parsed ruleset.
+
+    Returns:
+        A list of lists of 2-tuples. The first element of each tuple is
+        True if the token is optional, and the second is the token.
+
+    """
+    result = [[]]
+    optional = False
+    for token in production:
+        if isinstance(token, Control):
+            if token.content == SELECTION:
+                result.append([])
+            else:
+                assert token.content == OPTION
+                optional = True
+        else:
+            result[-1].append((optional, token))
+            optional = False
+    return result
+
+
+def terminal_text(token):
+    """Get the text that represents a terminal in a terminal sequence.
+
+    This is the form in which terminals appear in the output of the
+    all_terminals() function: literals with square brackets escaped, and
+    database lookups in square brackets.
+
+    """
+    return (token.escape_brackets() if isinstance(token, Literal) else
+            str(token))
+
+
+def _bottom_up(alts):
+    """List nonterminals so that each comes after all it depends on.
+
+    Keyword arguments:
+        alts -- A mapping of nonterminal names to their alternatives, as
+            from alternatives().
+
+    """
+    dependencies = {name: [token.content for alternative in alternatives
+                           for _, token in alternative
+                           if isinstance(token, Nonterminal)]
+                    for name, alternatives in alts.items()}
+    return reversed(toposort(dependencies))
+
+
+def _alternative_counts(alternatives, counts, lookup_weights=None):
+    """Yield the number of derivations of each alternative.
+
+    Keyword arguments:
+        alternatives -- A list of alternatives, as from alternatives().
+        counts -- A mapping of nonterminal names to their number of
+            derivations, for every nonterminal in the alternatives.
+        lookup_weights -- As for count_derivations().
+
+    """
+    for alternative in alternatives:
+        weight = 1
+        for optional, token in alternative:
+            weight *= ((counts[token.content]
+                        if isinstance(token, Nonterminal) else
+                        1 if lookup_weights is None or
+                        isinstance(token, Literal) else
+                        lookup_weights[token.content]) +
+                       (1 if optional else 0))
+        yield weight
+
+
+def _count_derivations(alts, lookup_weights=None):
+    """Count the derivations of every nonterminal, bottom-up.
+
+    Keyword arguments:
+        alts -- A mapping of nonterminal names to lists of alternatives,
+            as from alternatives().
+        lookup_weights -- As for count_derivations().
+
+    Returns:
+        A dictionary mapping each nonterminal name to its count.
+
+    """
+    counts = {}
+    for name in _bottom_up(alts):
+        counts[name] = sum(_alternative_counts(alts[name], counts,
+                                               lookup_weights))
+    return counts
+
+
+def count_derivations(rules, lookup_weights=None):
+    """Count the derivations of every nonterminal in a parsed ruleset.
+
+    Counting is done bottom-up over the rule dependencies, so it takes
+    time roughly proportional to the size of the ruleset, however many
+    terminal sequences it can produce.
+        >>> test_rules = {INITIAL: [Nonterminal('A'), Control(OPTION),
+        ...                         DBLookup('B')],
+        ...               'A': [Literal('x'), Control(SELECTION),
+        ...                     Literal('y')]}
+        >>> count_derivations(test_rules)[INITIAL]
+        4
+        >>> count_derivations(test_rules, {'B': 10})[INITIAL]
+        22
+
+    Keyword arguments:
+        rules -- A parsed ruleset, as from parse_rules().
+        lookup_weights -- A mapping of database lookup column names to
+            the number of values each can take. If given, each database
+            lookup counts as that many derivations instead of one.
+
+    Returns:
+        A dictionary mapping nonterminal names to integers.
+
+    """
+    return _count_derivations({name: alternatives(production)
+                               for name, production in rules.items()},
+                              lookup_weights)
+
+
+def count_terminals(rules, upper_bound=False, max_states=100000):
+    r"""Count the distinct terminal sequences of a parsed ruleset.
+
+    The result is the number of sequences that all_terminals() would
+    produce, but they are not enumerated. Instead, the rules are
+    treated as a nondeterministic automaton over the characters of each
+    terminal sequence, and accepting paths are counted over its subset
+    construction, so that sequences derivable in more than one way are
+    counted once.
+
+    Each state of the automaton is a set of call stacks, so there can be
+    exponentially many in the depth of the rules. If there turn out to
+    be more than max_states, counting is abandoned, and nothing is
+    returned; the cheap upper bound is still available by passing
+    upper_bound=True.
+        >>> test_rules = {INITIAL: [Nonterminal('A'), Nonterminal('A')],
+        ...               'A': [Control(OPTION), Literal('x')]}
+        >>> count_terminals(test_rules)
+        3
+        >>> count_terminals(test_rules, upper_bound=True)
+        4
+        >>> print(count_terminals(test_rules, max_states=2))
+        None
+
+    Keyword arguments:
+        rules -- A parsed ruleset, as from parse_rules().
+        upper_bound -- True if only a cheap upper bound is wanted. This
+            is the number of derivations, which counts each sequence
+            once per way of deriving it. The default is False.
+        max_states -- The most automaton states to explore before
+            giving up on an exact count, or None for no limit. The
+            default is 100,000.
+
+    Returns:
+        An integer, or None if counting was abandoned.
+
+    """
+    if upper_bound:
+        return count_derivations(rules)[INITIAL]
+    return _count_distinct(rules, max_states)
+
+
+def _count_distinct(rules, max_states, by_lookups=False, nonempty=False):
+    """Count the distinct terminal sequences of a ruleset, if possible.
+
+    Keyword arguments:
+        rules, max_states -- As for count_terminals().
+        by_lookups -- True to count the sequences by their lookups, as
+            count_lookup_sets() does. The default is False.
+        nonempty -- True to leave out the empty sequence. The default
+            is False.
+
+    Returns:
+        An integer, or a Counter if by_lookups is true, or None if there
+        were more than max_states states.
+
+    """
+    alts = {name: alternatives(production)
+            for name, production in rules.items()}
+
+    def token_at(stack):
+        name, alt, item = stack[-1]
+        return alts[name][alt][item]
+
+    def closure(stacks):
+        # Follow every path from the given positions that consumes no
+        # characters. A position is a stack of (nonterminal, alternative,
+        # item) frames, and the empty stack means the end of <RESULT>. Return
+        # the positions inside non-empty terminals, at their first character.
+        positions, todo, done = set(), list(stacks), set()
+        while len(todo) > 0:
+            stack = todo.pop()
+            if stack in done:
+                continue
+            done.add(stack)
+            if len(stack) == 0:
+                positions.add(((), 0))
+                continue
+
+            name, alt, item = stack[-1]
+            if item == len(alts[name][alt]):
+                # End of an alternative: return to where it was used.
+                todo.append(stack[:-2] + ((stack[-2][0], stack[-2][1],
+                                           stack[-2][2] + 1),)
+                            if len(stack) > 1 else ())
+                continue
+
+            optional, token = alts[name][alt][item]
+            skip = stack[:-1] + ((name, alt, item + 1),)
+            if optional:
+                todo.append(skip)
+            if isinstance(token, Nonterminal):
+                todo.extend(stack + ((token.content, n, 0),)
+                            for n in range(len(alts[token.content])))
+            elif terminal_text(token) == '':
+                todo.append(skip)
+            else:
+                positions.add((stack, 0))
+        return frozenset(positions)
+
+    def transitions(state):
+        # Group the positions in a state by the next character to consume,
+        # and return each character with the state that it leads to. A
+        # database lookup is consumed whole, as one "character" of its
+        # full text, so that it can be told apart from literal characters.
+        moves = defaultdict(set)
+        pending = defaultdict(list)
+        for stack, offset in state:
+            if len(stack) == 0:
+                continue
+            token = token_at(stack)[1]
+            text = terminal_text(token)
+            if isinstance(token, DBLookup):
+                char = text
+            elif offset + 1 < len(text):
+                moves[text[offset]].add((stack, offset + 1))
+                continue
+            else:
+                char = text[offset]
+            name, alt, item = stack[-1]
+            pending[char].append(stack[:-1] + ((name, alt, item + 1),))
+        return [(char, frozenset(moves[char]) | closure(pending[char]))
+                for char in moves.keys() | pending.keys()]
+
+    def lookup_sets(state, next_states):
+        # Group the accepting paths from a state by the columns they look
+        # up, given the groups for each of the states that it leads to.
+        sets = Counter({(): 1} if ((), 0) in state else {})
+        for char, next_state in next_states:
+            for colnames, count in counts[next_state].items():
+                if len(char) > 1:
+                    colnames = tuple(sorted(colnames + (char[1:-1],)))
+                sets[colnames] += count
+        return sets
+
+    # Count accepting paths from each state, depth first, remembering the
+    # count for each state so that shared suffixes are only counted once.
+    counts, explored = {}, 0
+    start = closure([((INITIAL, n, 0),) for n in range(len(alts[INITIAL]))])
+    stack = [(start, None)]
+    while len(stack) > 0:
+        state, next_states = stack[-1]
+        if state in counts:
+            stack.pop()
+        elif next_states is None:
+            explored += 1
+            if max_states is not None and explored > max_states:
+                if stats.enabled:
+                    stats.count('count_terminals_abandoned')
+                return None
+            next_states = transitions(state)
+            stack[-1] = (state, next_states)
+            stack.extend((next_state, None) for _, next_state in next_states
+                         if next_state not in counts)
+        else:
+            stack.pop()
+            counts[state] = (lookup_sets(state, next_states) if by_lookups
+                             else (1 if ((), 0) in state else 0) +
+                             sum(counts[next_state]
+                                 for _, next_state in next_states))
+    count = counts[start]
+    if nonempty and ((), 0) in start:
+        # The start state only accepts there if nothing was consumed.
+        count = count - Counter({(): 1}) if by_lookups else count - 1
+    return count
+
+
+def count_lookup_sets(rules, max_states=100000, nonempty=False):
+    """Count the distinct terminal sequences by the lookups they make.
+
+    Sequences are grouped by the database lookups in them, as a sorted
+    tuple of column names, with one entry per lookup. They are counted
+    in the same way as by count_terminals(), and so are not enumerated,
+    and those derivable in more than one way are counted once.
+        >>> test_rules = {INITIAL: [Control(OPTION), DBLookup('B'),
+        ...                         Nonterminal('A')],
+        ...               'A': [DBLookup('A'), Control(SELECTION),
+        ...                     Control(OPTION), Literal('x'),
+        ...                     Control(OPTION), Literal('x'),
+        ...                     DBLookup('B')]}
+        >>> sorted(count_lookup_sets(test_rules).items())
+        [(('A',), 1), (('A', 'B'), 1), (('B',), 3), (('B', 'B'), 3)]
+        >>> print(count_lookup_sets(test_rules, max_states=2))
+        None
+        >>> optional_rules = {INITIAL: [Control(OPTION), DBLookup('A')]}
+        >>> sorted(count_lookup_sets(optional_rules).items())
+        [((), 1), (('A',), 1)]
+        >>> sorted(count_lookup_sets(optional_rules, nonempty=True).items())
+        [(('A',), 1)]
+
+    Keyword arguments:
+        rules -- A parsed ruleset, as from parse_rules().
+        max_states -- As for count_terminals().
+        nonempty -- True to leave out the empty sequence, which is never
+            stored as an output format in the database. The default is
+            False.
+
+    Returns:
+        A dictionary mapping tuples of column names to the number of
+        sequences with those lookups, or None if counting was abandoned.
+
+    """
+    sets = _count_distinct(rules, max_states, by_lookups=True,
+                           nonempty=nonempty)
+    return None if sets is None else dict(sets)
+
+
+class TerminalSampler:
+    """Draw random terminal sequences directly from a parsed ruleset.
+
+    Each nonterminal, and each alternative and optional token within
+    it, is weighted by the number of derivations below it. A sequence
+    can then be drawn uniformly at random in time proportional to its
+    length, without enumerating every sequence as all_terminals() does.
+
+    Some rulesets can derive the same sequence in more than one way. By
+    default, such sequences are accepted with probability inversely
+    proportional to their number of derivations, so that every distinct
+    sequence is equally likely (as if picked from the output of
+    all_terminals()).
+
+    Attributes:
+        rules -- The parsed ruleset.
+        distinct -- True if sampling is uniform over distinct sequences,
+            or False if it is uniform over derivations (which is faster,
+            and the same thing when no sequence has two derivations).
+        counts -- A mapping of nonterminal names to the number of
+            derivations of each.
+
+    """
+    def __init__(self, rules, distinct=True, cache_size=65536):
+        """Initialise the sampler.
+
+        Keyword arguments:
+            rules -- As the instance attribute.
+            distinct -- As the instance attribute. The default is True.
+            cache_size -- The number of terminal sequences for which to
+                remember the result of multiplicity(). The default is
+                65536.
+
+        """
+        self.rules = rules
+        self.distinct = distinct
+        self.multiplicity = lru_cache(maxsize=cache_size)(self.multiplicity)
+        self._alternatives = {name: alternatives(production)
+                              for name, production in rules.items()}
+        self.counts = _count_derivations(self._alternatives)
+
+        # Convert the weights of each nonterminal's alternatives into
+        # cumulative totals, for bisection.
+        self._cumulative = {}
+        for name, alts in self._alternatives.items():
+            cumulative, total = [], 0
+            for weight in _alternative_counts(alts, self.counts):
+                total += weight
+                cumulative.append(total)
+            self._cumulative[name] = cumulative
+
+    def _count(self, token):
+        return (self.counts[token.content] if isinstance(token, Nonterminal)
+                else 1)
+
+    def sample_derivation(self, rng=random):
+        """Draw a derivation uniformly at random.
+
+        Keyword arguments:
+            rng -- A random number generator with a randrange() method.
+                The default is the random module itself.
+
+        Returns:
+            A terminal sequence, as a string.
+
+        """
+        output = []
+        stack = [Nonterminal(INITIAL)]
+        while len(stack) > 0:
+            token = stack.pop()
+            if not isinstance(token, Nonterminal):
+                output.append(terminal_text(token))
+                continue
+
+            cumulative = self._cumulative[token.content]
+            choice = bisect_right(cumulative, rng.randrange(cumulative[-1]))
+            for optional, item in reversed(
+                    self._alternatives[token.content][choice]):
+                # Include an optional token in proportion to its count.
+                if (not optional or
+                        rng.randrange(self._count(item) + 1) > 0):
+                    stack.append(item)
+        return ''.join(output)
+
+    def sample(self, rng=random):
+        """Draw a terminal sequence uniformly at random.
+
+        Keyword arguments:
+            rng -- As for sample_derivation().
+
+        Returns:
+            A terminal sequence, as a string.
+
+        """
+        while True:
+            terminal_seq = self.sample_derivation(rng)
+            if (not self.distinct or
+                    rng.randrange(self.multiplicity(terminal_seq)) == 0):
+                return terminal_seq
+            if stats.enabled:
+                stats.count('sampler_rejections')
+
+    def multiplicity(self, terminal_seq):
+        """Count the derivations of a terminal sequence.
+
+        Keyword arguments:
+            terminal_seq -- A terminal sequence, as a string.
+
+        Returns:
+            An integer, which is zero if the sequence cannot be derived.
+
+        """
+        memo = {}
+
+        def ends(token, pos):
+            # Map each position where the token could end, if it starts at
+            # pos, to the number of ways it could end there.
+            if not isinstance(token, Nonterminal):
+                text = terminal_text(token)
+                return ({pos + len(text): 1}
+                        if terminal_seq.startswith(text, pos) else {})
+
+            key = (token.content, pos)
+            if key not in memo:
+                total = Counter()
+                for alternative in self._alternatives[token.content]:
+                    here = {pos: 1}
+                    for optional, item in alternative:
+                        there = Counter()
+                        for start, ways in here.items():
+                            if optional:
+                                there[start] += ways
+                            for end, more_ways in ends(item, start).items():
+                                there[end] += ways * more_ways
+                        here = there
+                    total.update(here)
+                memo[key] = total
+            return memo[key]
+
+        return ends(Nonterminal(INITIAL), 0).get(len(terminal_seq), 0)
+
+
 def parse_terminals(s):
     r"""Parse a string for a sequence of terminals.
 
@@ -507,8 +1158,23 @@ def parse_terminals(s):
     return tokens
 
 
+def compile_terminals(s):
+    r"""Compile a string of terminals into a generation plan.
+
+    The plan is an immutable sequence of 2-tuples, one for each segment
+    of the output. Literal segments are (text, None); database lookups
+    are (None, column name). Empty literals are left out.
+        >>> compile_terminals('Hello, \[friend\] [Name]!')
+        (('Hello, [friend] ', None), (None, 'Name'), ('!', None))
+
+    """
+    return tuple((token.content, None) if isinstance(token, Literal) else
+                 (None, token.content)
+                 for token in parse_terminals(s)
+                 if not (isinstance(token, Literal) and token.content == ''))
+
+
 if __name__ == '__main__':
-    import sys
     try:
         rules = parse_rules(sys.argv[1])
     except IndexError:
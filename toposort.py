@@ -16,12 +16,20 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-# Standard library imports.
-from copy import deepcopy
-
 
 class CyclicGraphError(Exception):
-    pass
+    """The graph cannot be sorted, because it contains a cycle.
+
+    Attributes:
+        cycle -- A list of nodes forming a cycle, starting and ending
+            with the same node, or None if no cycle was found among the
+            nodes left unsorted (as can happen if the startnodes given
+            to toposort() are not the only nodes without incoming edges).
+
+    """
+    def __init__(self, message, cycle=None):
+        super().__init__(message)
+        self.cycle = cycle
 
 
 def unreachable_nodes(graph):
@@ -33,6 +41,55 @@ def unreachable_nodes(graph):
     return candidates
 
 
+def find_cycle(graph, nodes=None):
+    """Find a cycle in a directed graph.
+
+    The graph is searched depth-first, so this takes time linear in the
+    size of the graph. The graph is not modified.
+        >>> find_cycle({'a': ['b'], 'b': ['c'], 'c': ['a', 'd'], 'd': []})
+        ['a', 'b', 'c', 'a']
+        >>> find_cycle({'a': ['b'], 'b': []}) is None
+        True
+
+    Keyword arguments:
+        graph -- The graph to be searched, represented as for toposort().
+        nodes -- The nodes to search from, and to limit the search to.
+            If omitted, the whole graph is searched.
+
+    Returns:
+        A list of nodes, starting and ending with the same node, or None
+        if there is no cycle.
+
+    """
+    if nodes is None:
+        nodes = graph.keys()
+    # Nodes not yet visited are absent from this mapping. Those whose
+    # descendants are still being searched map to True, and those that are
+    # finished map to False.
+    on_path = {}
+    for start in nodes:
+        if start in on_path:
+            continue
+        path = [start]
+        on_path[start] = True
+        stack = [iter(graph.get(start, ()))]
+        while len(stack) > 0:
+            for dest in stack[-1]:
+                if dest not in nodes:
+                    continue
+                if on_path.get(dest):
+                    return path[path.index(dest):] + [dest]
+                if dest not in on_path:
+                    path.append(dest)
+                    on_path[dest] = True
+                    stack.append(iter(graph.get(dest, ())))
+                    break
+            else:
+                on_path[path.pop()] = False
+                stack.pop()
+    return None
+
+
 def toposort(graph, startnodes=None):
     """Perform topological sorting on a directed graph.
 
@@ -41,7 +98,12 @@ def toposort(graph, startnodes=None):
     This is the representation used in the essay "Python Patterns -
     Implementing Graphs" <https://www.python.org/doc/essays/graphs/>.
 
-    The sort algorithm is from Kahn (1962).
+    The sort algorithm is from Kahn (1962). Arcs are not removed from
+    the graph; instead, a count of incoming arcs is kept for each node,
+    so the sort takes time linear in the size of the graph, and the
+    graph itself is left unchanged.
+        >>> toposort({'a': ['b', 'c'], 'b': ['c'], 'c': []})
+        ['a', 'b', 'c']
 
     Keyword arguments:
         graph -- The graph to be sorted.
@@ -50,24 +112,45 @@ def toposort(graph, startnodes=None):
             of the algorithm; thus, providing this information can save
             time if it is already known.
 
+    Returns:
+        A list of nodes, such that every arc goes from an earlier node
+        to a later one.
+
+    Raises:
+        CyclicGraphError -- If some arcs could not be sorted. Its cycle
+            attribute holds the offending cycle, if there is one.
+
     """
-    sorted_elements = []
-    editable_graph = deepcopy(graph)
-    editable_nodes = (unreachable_nodes(graph) if startnodes is None else
-                      deepcopy(startnodes))
+    in_degree = {}
+    for destinations in graph.values():
+        for dest in destinations:
+            in_degree[dest] = in_degree.get(dest, 0) + 1
 
-    while len(editable_nodes) > 0:
-        node = editable_nodes.pop()
+    sorted_elements = []
+    ready = list(unreachable_nodes(graph) if startnodes is None else
+                 startnodes)
+    while len(ready) > 0:
+        node = ready.pop()
         sorted_elements.append(node)
 
-        destinations = editable_graph[node]
-        editable_graph[node] = []
-        unreachable_now = unreachable_nodes(editable_graph)
-        for dest in destinations:
-            if dest in unreachable_now:
-                editable_nodes.add(dest)
+        for dest in graph.get(node, ()):
+            in_degree[dest] -= 1
+            if in_degree[dest] == 0:
+                ready.append(dest)
 
-    if any(len(destinations) > 0 for destinations in editable_graph.values()):
-        raise CyclicGraphError('cannot sort graph: cycle exists')
+    sorted_set = set(sorted_elements)
+    unsorted = {node for node, destinations in graph.items()
+                if node not in sorted_set and len(destinations) > 0}
+    if len(unsorted) > 0:
+        raise CyclicGraphError('cannot sort graph: cycle exists',
+                               find_cycle(graph, unsorted |
+                                          {dest for node in unsorted
+                                           for dest in graph[node]
+                                           if dest not in sorted_set}))
     else:
         return sorted_elements
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()